@@ -0,0 +1,305 @@
+"""探索戦略のオフラインベンチマーク
+
+合成した状態機械（カテゴリ数・値の数・アクション数・ガードの密度・自動遷移）と
+シード付きの TestModel のバグ定義の上で、探索木（ExplorerTree）の selection_method と
+状態グラフ（Explorer）の method を複数シードで走らせ、次の指標を JSON で出力する。
+
+- iterations_to_first_bug: 最初のバグが出たイテレーション（出なければ null）
+- bugs_per_1k_actions: 1000 操作あたりのバグ検出数
+- wall_per_iter_ms: 1イテレーションあたりの実行時間
+- peak_memory_kb: 実行中のメモリ使用量のピーク（tracemalloc。無効なら null）
+- probabilities_ok: 探索木の分岐確率が最後まで有限で合計1のままか（状態グラフは null）
+
+使い方:
+    python -m src.Benchmark --seeds 10 --iters 200 --out bench.json
+    python -m src.Benchmark --no-memory --profile bench.pstats  # cProfile の結果も書き出す
+"""
+from pathlib import Path
+import sys
+import io
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import contextlib
+import tracemalloc
+import yaml
+
+# パス設定
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src import Config as config_module
+from src.Config import Config, compile_action
+from src.Model import TestModel
+from src.ExplorerActbase import ExplorerTree, ExplorerNode
+from src.ExplorerStateBase import Explorer
+from src import Engine, EngineStateBase
+from src import Profiling
+from src.Log import get_logger
+
+log = get_logger("Benchmark")
+
+TREE_METHODS = ["probability", "ucb", "epsilon_greedy", "random", "thompson"]
+GRAPH_METHODS = ["random", "least_tried", "weighted", "coverage", "thompson"]
+
+
+def make_config(n_categories=3, n_values=3, n_actions=6, guard_density=0.5,
+                auto_transitions=1, seed=0):
+    """config.yaml と同じ形式の合成状態機械
+    @param guard_density: 各アクションが各カテゴリに required を持つ確率
+    @param auto_transitions: 自動遷移を持つカテゴリの数
+    """
+    rng = random.Random(seed)
+    states = {}
+    for c in range(n_categories):
+        values = [f"c{c}v{v}" for v in range(n_values)]
+        states[f"cat{c}"] = {"all": values, "initial": values[0], "timeout": 1}
+    categories = list(states)
+    for name in rng.sample(categories, min(auto_transitions, n_categories)):
+        values = states[name]["all"]
+        src, dst = rng.sample(values, 2)
+        states[name]["auto_transitions"] = {src: {"after": rng.randint(1, 3), "to": dst}}
+
+    actions = {}
+    for a in range(n_actions):
+        all_of = {}
+        for name in categories:
+            if rng.random() < guard_density:
+                allowed = rng.sample(states[name]["all"], rng.randint(1, n_values - 1 or 1))
+                all_of[name] = [{"condition": f"in [{', '.join(allowed)}]"}]
+        transitions = {}
+        for name in rng.sample(categories, rng.randint(1, min(2, n_categories))):
+            transitions[name] = rng.choice(states[name]["all"])
+        actions[f"ACT{a}"] = {"required": {"all_of": all_of}, "transitions": transitions}
+    return {"states": states, "actions": actions}
+
+
+def make_bugs(config, n_bugs=3, length=3, prob=0.5, seed=0, wait_range=None, max_tries=1000):
+    """初期状態からのランダムウォークで実行可能なバグの path を作る
+    @param wait_range: [min, max] を渡すと操作の間に "wait:N" を挟む（探索木は操作と待機が交互）。
+                       操作の並びは wait_range の有無によらず同じ seed なら同じ
+    @param max_tries: ランダムウォークの回数の上限。長さ length の path が作れない状態機械では
+                      n_bugs 個に満たないまま返す
+    """
+    rng = random.Random(seed)
+    wait_rng = random.Random(seed + 1)
+    compiled = {name: compile_action(name, defn) for name, defn in config["actions"].items()}
+    categories = list(config["states"])
+    init = {name: defn["initial"] for name, defn in config["states"].items()}
+    bugs = []
+    for _ in range(max_tries):
+        if len(bugs) >= n_bugs:
+            break
+        state = dict(init)
+        # 途中から始まる path にもなるよう、先頭の何手かは捨てる
+        acts = []
+        for _ in range(rng.randint(0, 2) + length):
+            allowed = [name for name, op in compiled.items() if op.is_allowed(state)]
+            if not allowed:
+                break
+            act = rng.choice(allowed)
+            acts.append(act)
+            state = compiled[act].next_state(state)
+        acts = acts[-length:]
+        if len(acts) < length:
+            continue
+        path = []
+        for act in acts:
+            if path and wait_range is not None:
+                path.append(f"wait:{wait_rng.randint(wait_range[0], wait_range[1])}")
+            path.append(act)
+        bugs.append({"path": path, "prob": prob, "bug": [rng.choice(categories)]})
+    if len(bugs) < n_bugs:
+        log.warning("make_bugs: only %d of %d bug paths of length %d after %d walks (seed=%d)",
+                    len(bugs), n_bugs, length, max_tries, seed)
+    return bugs
+
+
+@contextlib.contextmanager
+def use_config(config):
+    """config を一時ファイルに書き出し、その間だけ状態機械の設定として使う"""
+    old_path = config_module.yaml_path
+    fd, path = tempfile.mkstemp(suffix=".yaml")
+    try:
+        with os.fdopen(fd, "w") as f:
+            yaml.safe_dump(config, f)
+        config_module.set_yaml_path(path)
+        Config().load()
+        yield path
+    finally:
+        config_module.set_yaml_path(old_path)
+        os.remove(path)
+
+
+class _BenchmarkModel(TestModel):
+    """リセットで状態機械を初期状態に戻す TestModel
+    合成した設定には初期状態に戻す reset_acts が無いので、reset_acts の代わりに直接戻す。
+    戻さないと毎回前のイテレーションの最終状態から始まり、探索が途中で打ち切られる"""
+    def reset(self):
+        self.sm.reset_states()
+        super().reset()
+
+
+def _model(actions, bugs):
+    model = _BenchmarkModel()
+    model.set_acts(actions)
+    model.set_reset_acts([])
+    model.set_bugs(bugs)
+    return model
+
+
+def make_tree_engine(method, actions, bugs, seed, max_iter, max_depth=5, wait_range=(1, 3)):
+    model = _model(actions, bugs)
+    root = ExplorerNode("START", acts=actions, wait_range=list(wait_range), probability=1.0,
+                        probability_limit=[0.1, 0.9], freeze_count=4, path_hist=[],
+                        is_action=False)
+    tree = ExplorerTree(root, max_depth=max_depth, selection_method=method)
+    engine = Engine.SearchEngine(model=model, root=root, tree=tree, max_iter=max_iter,
+                                 seed=seed, log=False, settle=0)
+    return engine, model
+
+
+def make_graph_engine(method, actions, bugs, seed, max_iter, max_steps=5):
+    model = _model(actions, bugs)
+    graph = Explorer(actions, max_steps=max_steps, log=False, cache_dir=None, method=method)
+    engine = EngineStateBase.SearchEngine(model=model, graph=graph, max_iter=max_iter,
+                                          seed=seed, log=False, settle=0)
+    return engine, model
+
+
+def run_once(engine, model, max_iter, trace_memory=True):
+    """engine を max_iter 回（探索済みならそこまで）回して1回分の指標を返す"""
+    if trace_memory:
+        tracemalloc.start()
+    first = None
+    i = 0
+    start = time.perf_counter()
+    # 状態機械・TestModel のログ出力は捨てる
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine.prepare()
+        while i < max_iter and not engine.finish:
+            i += 1
+            engine.run_iteration(model, i)
+            if first is None and model.total_bug_count:
+                first = i
+    wall = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    actions = model.total_act_count
+    tree = getattr(engine, "tree", None)
+    return {
+        "iterations": i,
+        "iterations_to_first_bug": first,
+        "bugs": model.total_bug_count,
+        "actions": actions,
+        "bugs_per_1k_actions": 1000 * model.total_bug_count / actions if actions else 0.0,
+        "wall_per_iter_ms": 1000 * wall / i if i else 0.0,
+        "peak_memory_kb": peak,
+        "probabilities_ok": None if tree is None else not tree.root.store.check_probabilities(),
+    }
+
+
+def summarize(runs, max_iter=None):
+    """シードごとの結果の集計（未検出のシードは iterations_to_first_bug の集計から除く）
+    max_iter を渡すと未検出のシードを max_iter + 1 回とみなした平均も出す（方法どうしの比較用）"""
+    firsts = [r["iterations_to_first_bug"] for r in runs if r["iterations_to_first_bug"] is not None]
+    peaks = [r["peak_memory_kb"] for r in runs if r["peak_memory_kb"] is not None]
+    penalized = None
+    if max_iter is not None:
+        penalized = statistics.mean(max_iter + 1 if r["iterations_to_first_bug"] is None
+                                    else r["iterations_to_first_bug"] for r in runs)
+    return {
+        "found_rate": len(firsts) / len(runs),
+        "iterations_to_first_bug_mean": statistics.mean(firsts) if firsts else None,
+        "iterations_to_first_bug_median": statistics.median(firsts) if firsts else None,
+        "iterations_to_first_bug_penalized_mean": penalized,
+        "bugs_per_1k_actions_mean": statistics.mean(r["bugs_per_1k_actions"] for r in runs),
+        "wall_per_iter_ms_mean": statistics.mean(r["wall_per_iter_ms"] for r in runs),
+        "peak_memory_kb_max": max(peaks) if peaks else None,
+        "probabilities_ok": all(r["probabilities_ok"] is not False for r in runs),
+    }
+
+
+def run_benchmark(seeds=10, max_iter=200, config_params=None, n_bugs=3, bug_length=3,
+                  bug_prob=0.5, tree_methods=TREE_METHODS, graph_methods=GRAPH_METHODS,
+                  wait_range=(1, 3), trace_memory=True):
+    """全戦略を seeds 個のシードで走らせ、JSON にできる辞書を返す
+    シード s ごとに状態機械・バグ定義を作り直し、全戦略で同じものを使う
+    """
+    config_params = dict(config_params or {})
+    results = {f"tree:{m}": [] for m in tree_methods}
+    results.update({f"graph:{m}": [] for m in graph_methods})
+    for seed in range(seeds):
+        config = make_config(seed=seed, **config_params)
+        actions = list(config["actions"])
+        # 探索木の path は操作と待機が交互、状態グラフの path は操作のみ
+        tree_bugs = make_bugs(config, n_bugs, bug_length, bug_prob, seed, wait_range)
+        graph_bugs = make_bugs(config, n_bugs, bug_length, bug_prob, seed)
+        with use_config(config):
+            for m in tree_methods:
+                engine, model = make_tree_engine(m, actions, tree_bugs, seed, max_iter,
+                                                 wait_range=wait_range)
+                results[f"tree:{m}"].append(run_once(engine, model, max_iter, trace_memory))
+            for m in graph_methods:
+                engine, model = make_graph_engine(m, actions, graph_bugs, seed, max_iter)
+                results[f"graph:{m}"].append(run_once(engine, model, max_iter, trace_memory))
+    return {
+        "params": {
+            "seeds": seeds, "max_iter": max_iter, "config": config_params, "n_bugs": n_bugs,
+            "bug_length": bug_length, "bug_prob": bug_prob, "wait_range": list(wait_range),
+            "trace_memory": trace_memory,
+        },
+        "summary": {name: summarize(runs, max_iter) for name, runs in results.items()},
+        "runs": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="探索戦略のオフラインベンチマーク")
+    parser.add_argument("--seeds", type=int, default=10)
+    parser.add_argument("--iters", type=int, default=200)
+    parser.add_argument("--categories", type=int, default=3)
+    parser.add_argument("--values", type=int, default=3)
+    parser.add_argument("--actions", type=int, default=6)
+    parser.add_argument("--guard-density", type=float, default=0.5)
+    parser.add_argument("--auto-transitions", type=int, default=1)
+    parser.add_argument("--bugs", type=int, default=3)
+    parser.add_argument("--bug-length", type=int, default=3)
+    parser.add_argument("--bug-prob", type=float, default=0.5)
+    parser.add_argument("--tree-methods", nargs="*", default=TREE_METHODS)
+    parser.add_argument("--graph-methods", nargs="*", default=GRAPH_METHODS)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="tracemalloc を使わない（実行時間への影響をなくす）")
+    parser.add_argument("--profile", help="cProfile の結果を pstats 形式で書き出すファイル")
+    parser.add_argument("--out", help="結果の JSON を書き出すファイル（省略時は標準出力）")
+    args = parser.parse_args(argv)
+
+    with contextlib.ExitStack() as stack:
+        if args.profile:
+            stack.enter_context(Profiling.profile(args.profile))
+        result = run_benchmark(
+            seeds=args.seeds, max_iter=args.iters,
+            config_params={
+                "n_categories": args.categories, "n_values": args.values,
+                "n_actions": args.actions, "guard_density": args.guard_density,
+                "auto_transitions": args.auto_transitions,
+            },
+            n_bugs=args.bugs, bug_length=args.bug_length, bug_prob=args.bug_prob,
+            tree_methods=args.tree_methods, graph_methods=args.graph_methods,
+            trace_memory=not args.no_memory,
+        )
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
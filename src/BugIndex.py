@@ -0,0 +1,75 @@
+from collections import deque
+
+
+class BugPathIndex:
+    """バグ定義の path をまとめた Aho–Corasick オートマトン
+
+    履歴のトークン（"CAN_ACCON", "wait:1" など）は整数に置き換えて遷移する。
+    push で1トークンずつ進め、その位置で終わる path の出現回数を数える。
+    1手あたりの計算量は（出現の数を除いて）バグ定義の数によらず償却 O(1)。
+    pop で直前の push を取り消せる（履歴を途中まで戻すとき用）。
+    """
+    def __init__(self, paths):
+        self.tokens = {}   # トークン -> 整数
+        self.goto = [{}]   # 状態 -> {トークン: 次の状態}
+        self.fail = [0]
+        self.out = [[]]    # 状態 -> この状態で終わる path の index
+        for pid, path in enumerate(paths):
+            s = 0
+            for token in path:
+                t = self.tokens.setdefault(token, len(self.tokens))
+                nxt = self.goto[s].get(t)
+                if nxt is None:
+                    nxt = self.goto[s][t] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                s = nxt
+            if path:
+                self.out[s].append(pid)
+
+        # 幅優先で失敗遷移を張る（出力は失敗先の分もまとめておく）
+        queue = deque(self.goto[0].values())
+        while queue:
+            s = queue.popleft()
+            for t, nxt in self.goto[s].items():
+                f = self.fail[s]
+                while f and t not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(t, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+                queue.append(nxt)
+        self.clear()
+
+    def clear(self):
+        self.state = 0
+        self.counts = {}   # path の index -> 出現回数
+        self._trail = []   # push ごとの (直前の状態, 出現した path)
+
+    def push(self, token):
+        t = self.tokens.get(token)
+        prev = s = self.state
+        if t is None:
+            # どの path にも無いトークン
+            s = 0
+        else:
+            while s and t not in self.goto[s]:
+                s = self.fail[s]
+            s = self.goto[s].get(t, 0)
+        self.state = s
+        matched = self.out[s]
+        for pid in matched:
+            self.counts[pid] = self.counts.get(pid, 0) + 1
+        self._trail.append((prev, matched))
+
+    def pop(self):
+        prev, matched = self._trail.pop()
+        for pid in matched:
+            self.counts[pid] -= 1
+            if not self.counts[pid]:
+                del self.counts[pid]
+        self.state = prev
+
+    def matches(self):
+        """出現した path の (index, 出現回数) を index 順に返す"""
+        return sorted(self.counts.items())
@@ -0,0 +1,136 @@
+import heapq
+import itertools
+import threading
+import time
+
+from src.Log import get_logger
+
+log = get_logger("Clock")
+
+
+class _Event:
+    __slots__ = ("when", "func", "cancelled")
+
+    def __init__(self, when, func):
+        self.when = when
+        self.func = func
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerScheduler:
+    """全 StateMachine の遅延実行を1本のスレッドで処理するスケジューラ
+    事象は (時刻, 登録順) のヒープで持ち、取り消された事象は先頭に来た時点で捨てる
+    """
+    def __init__(self):
+        self._queue = []  # (時刻, 登録順, _Event)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_later(self, delay, func):
+        event = _Event(time.monotonic() + delay, func)
+        with self._cond:
+            heapq.heappush(self._queue, (event.when, next(self._seq), event))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="TimerScheduler", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return event
+
+    def pending(self):
+        with self._cond:
+            return sum(1 for _, _, e in self._queue if not e.cancelled)
+
+    def _next_event(self):
+        with self._cond:
+            while True:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                when, _, event = self._queue[0]
+                if event.cancelled:
+                    heapq.heappop(self._queue)
+                    continue
+                delay = when - time.monotonic()
+                if delay <= 0:
+                    heapq.heappop(self._queue)
+                    return event
+                self._cond.wait(delay)
+
+    def _run(self):
+        while True:
+            event = self._next_event()
+            if event.cancelled:
+                continue
+            try:
+                event.func()
+            except Exception:
+                log.exception("TimerScheduler: timer callback failed")
+
+
+_scheduler = TimerScheduler()
+
+
+class Clock:
+    """実時間の時計。待機と遅延実行（自動遷移のタイマー）を提供する"""
+    realtime = True  # False の時計は sleep でしか時刻が進まない（実時間で待っても進まない）
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, duration):
+        if duration > 0:
+            time.sleep(duration)
+
+    def call_later(self, delay, func):
+        """delay 秒後に func を実行する。戻り値の cancel() で取り消せる
+        （スレッドは作らず、共有の TimerScheduler に登録する）"""
+        return _scheduler.call_later(delay, func)
+
+
+class VirtualClock(Clock):
+    """離散事象シミュレーション用の仮想時計
+    sleep は待たずに時刻を進め、その間に期限が来た call_later を時刻順に実行する。
+    同じ時刻の事象は登録順に実行するので、結果は実行環境によらず決定的になる。
+    時刻を進めるのは1スレッドからにすること（複数スレッドから sleep すると時刻が
+    足し合わされる）。キューと時刻の更新自体は排他するので、別スレッドからの call_later は安全。
+    """
+    realtime = False
+
+    def __init__(self, start=0.0):
+        self.time = start
+        self._queue = []  # (時刻, 登録順, _Event)
+        self._seq = itertools.count()
+        self._lock = threading.RLock()  # 事象の実行中に call_later されることがあるので RLock
+
+    def now(self):
+        return self.time
+
+    def sleep(self, duration):
+        self.advance(duration)
+
+    def call_later(self, delay, func):
+        with self._lock:
+            event = _Event(self.time + delay, func)
+            heapq.heappush(self._queue, (event.when, next(self._seq), event))
+        return event
+
+    def advance(self, duration):
+        """duration 秒だけ時刻を進め、期限の来た事象を実行する"""
+        with self._lock:
+            target = self.time + max(duration, 0)
+            queue = self._queue
+            while queue and queue[0][0] <= target:
+                when, _, event = heapq.heappop(queue)
+                if event.cancelled:
+                    continue
+                self.time = when
+                event.func()
+            self.time = target
+
+    def pending(self):
+        """未実行の事象数"""
+        with self._lock:
+            return sum(1 for _, _, e in self._queue if not e.cancelled)
@@ -1,4 +1,10 @@
+import ast
+import hashlib
+from dataclasses import dataclass
 import yaml
+from src.Log import get_logger
+
+log = get_logger("Config")
 
 yaml_path="data/config.yaml"
 
@@ -6,6 +12,166 @@ def set_yaml_path(path):
     global yaml_path
     yaml_path = path
 
+def convert_str_to_list(str_value):
+    """ "[a,b,c]" -> ["a", "b", "c"] """
+    str_value = str_value.strip()
+    if str_value.startswith("[") and str_value.endswith("]"):
+        items = str_value[1:-1].split(",")
+        return [item.strip().strip('"').strip("'") for item in items]
+    else:
+        raise ValueError(f"リスト形式ではありません: {str_value}")
+
+def _parse_values(rhs):
+    """条件式右辺のリストを値の集合に変換"""
+    try:
+        values = ast.literal_eval(rhs.strip())
+    except (ValueError, SyntaxError):
+        values = convert_str_to_list(rhs.strip())
+    if isinstance(values, (list, tuple, set, frozenset)):
+        return frozenset(values)
+    return frozenset([values])
+
+
+@dataclass(frozen=True)
+class Predicate:
+    """コンパイル済みの条件式（"in [a, b]" / "not in [a]" / "== a" / "!= a" / "else"）"""
+    op: str
+    values: frozenset = frozenset()
+
+    def __call__(self, value):
+        if self.op == "in":
+            return value in self.values
+        elif self.op == "not in":
+            return value not in self.values
+        elif self.op == "==":
+            return value in self.values
+        elif self.op == "!=":
+            return value not in self.values
+        return True  # else
+
+
+def compile_condition(condition_str):
+    """条件式の文字列をPredicateに変換する（evaluate_conditionと同じ解釈）"""
+    if condition_str == "else":
+        return Predicate("else")
+
+    if "not in " in condition_str:
+        _, rhs = condition_str.split("not in ")
+        return Predicate("not in", _parse_values(rhs))
+    elif "in " in condition_str:
+        _, rhs = condition_str.split("in ")
+        return Predicate("in", _parse_values(rhs))
+    elif "==" in condition_str:
+        _, rhs = condition_str.split("==")
+        return Predicate("==", frozenset([rhs.strip()]))
+    elif "!=" in condition_str:
+        _, rhs = condition_str.split("!=")
+        return Predicate("!=", frozenset([rhs.strip()]))
+    else:
+        raise ValueError(f"Unknown condition: {condition_str}")
+
+
+@dataclass(frozen=True)
+class Requirement:
+    """required ブロック。all_of / any_of は (カテゴリ, (Predicate, ...)) のタプル"""
+    all_of: tuple = ()
+    any_of: tuple = ()
+
+    def satisfied(self, state):
+        for key, preds in self.all_of:
+            value = state.get(key)
+            for pred in preds:
+                if not pred(value):
+                    return False
+        if self.any_of:
+            for key, preds in self.any_of:
+                value = state.get(key)
+                if any(pred(value) for pred in preds):
+                    return True
+            return False
+        return True
+
+
+@dataclass(frozen=True)
+class Transition:
+    """1カテゴリ分の transitions。rules は (Predicate, 遷移先) のタプル、
+    default は else（もしくは "audio: stopped" のような無条件遷移）の遷移先"""
+    category: str
+    rules: tuple = ()
+    default: object = None
+
+    def apply(self, value):
+        for pred, next_value in self.rules:
+            if pred(value):
+                return next_value
+        if self.default is not None:
+            return self.default
+        return value
+
+
+@dataclass(frozen=True)
+class CompiledAction:
+    name: str
+    required: Requirement
+    transitions: tuple  # (Transition, ...)
+
+    def is_allowed(self, state):
+        return self.required.satisfied(state)
+
+    def next_state(self, state):
+        next_states = state.copy()
+        for t in self.transitions:
+            if t.category in state:
+                next_states[t.category] = t.apply(state[t.category])
+                continue
+            # 状態に無いカテゴリは、条件か else が当てはまったときだけ追加する
+            next_value = t.apply(None)
+            if next_value is not None:
+                next_states[t.category] = next_value
+        return next_states
+
+
+def compile_required(required):
+    def compile_block(block):
+        return tuple(
+            (key, tuple(compile_condition(c.get("condition")) for c in conds))
+            for key, conds in block.items()
+        )
+    return Requirement(
+        all_of=compile_block(required.get("all_of", {}) or {}),
+        any_of=compile_block(required.get("any_of", {}) or {}),
+    )
+
+
+def compile_transitions(transitions):
+    compiled = []
+    for category, rules in transitions.items():
+        # Power: On のような書き方に対応
+        if isinstance(rules, str):
+            compiled.append(Transition(category, default=rules))
+            continue
+
+        conds = []
+        else_rule = None
+        for rule in rules:
+            cond = rule.get("condition")
+            if cond == "else":
+                else_rule = rule["next"]
+                continue
+            conds.append((compile_condition(cond), rule["next"]))
+        compiled.append(Transition(category, tuple(conds), else_rule))
+    return tuple(compiled)
+
+
+def compile_action(name, action_def):
+    """YAMLのアクション定義をCompiledActionに変換する"""
+    return CompiledAction(
+        name=name,
+        required=compile_required(action_def.get("required", {}) or {}),
+        transitions=compile_transitions(action_def.get("transitions", {}) or {}),
+    )
+
+
 class Config:
     _instance = None
 
@@ -15,14 +181,33 @@ class Config:
         return cls._instance
 
     def __init__(self):
+        # 同じファイルを読込済みなら再パースしない
+        if getattr(self, "path", None) == yaml_path:
+            return
+        self.load()
+
+    def load(self):
+        """yaml_path の設定を読み込む（ファイルを更新した場合は明示的に呼ぶ）"""
         with open(yaml_path, "r") as f:
-            config = yaml.safe_load(f)
+            text = f.read()
+        config = yaml.safe_load(text)
+        self.path = yaml_path
+        self.digest = hashlib.sha256(text.encode()).hexdigest()  # キャッシュのキー用
         self.states = config["states"]
         self.all_states = {name: defn.get("all", []) for name, defn in self.states.items()}
         self.actions = config["actions"]
+        # 条件式はロード時に一度だけコンパイルする
+        self.compiled_actions = {name: compile_action(name, defn)
+                                 for name, defn in self.actions.items()}
 
     def get_timeout(self, category):
         if category in self.states and "timeout" in self.states[category]:
             return self.states[category]["timeout"]
-        print(f"Warning: {category} timeout is not defined in config.yaml")
+        log.warning("%s timeout is not defined in config.yaml", category)
         return 0
+
+    def get_monitor_timeout(self, category):
+        """モニタで期待値になるまで待つ時間（monitor_timeout 未定義なら timeout）"""
+        if category in self.states and "monitor_timeout" in self.states[category]:
+            return self.states[category]["monitor_timeout"]
+        return self.get_timeout(category)
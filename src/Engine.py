@@ -6,24 +6,31 @@ import json
 import datetime
 import os
 import time
+import threading
+import numpy as np
 
 # パス設定
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
-from src.Explorer import ExplorerTree, ExplorerNode
+from src.ExplorerActbase import ExplorerTree, ExplorerNode
+from src.StateSpace import StateSpace, TransitionTable
+from src.StateMachine import simulate_actions, simulate_wait, reset_elapsed
+from src.ResultSink import read_results
+from src.Log import get_logger
 
-def SLEEP(duration):
-    """秒数待機"""
-    if 1:
-        time.sleep(duration)
+log = get_logger("Engine")
 
-def PRINT(msg):
-    """ログ出力"""
-    if 0:
-        print(msg)
+def SLEEP(duration, clock=None):
+    """秒数待機（clock を渡すとその時計で待つ。TestModel なら仮想時間が進むだけ）"""
+    if 1:
+        if clock is not None:
+            clock.sleep(duration)
+        else:
+            time.sleep(duration)
 
 class SearchEngine:
-    def __init__(self, model, root, tree, max_iter=100, seed=None, log=True, diagnose_bugs=True):
+    def __init__(self, model, root, tree, max_iter=100, seed=None, log=True, diagnose_bugs=True,
+                 batch_size=16, settle=1, planner=None, sink=None):
         self.model = model
         self.max_iter = max_iter
         self.root = root
@@ -33,99 +40,412 @@ class SearchEngine:
         if seed is not None:
             random.seed(seed)
         self.diagnose_bugs = diagnose_bugs
+        self.batch_size = batch_size  # 1回にまとめて検証する候補経路数の上限
+        self.table = None
+        self.use_table = True  # 状態空間が大きすぎて遷移表を作れなければ False（1本ずつ検証する）
+        # 経路の開始状態（最初のリセット直後の状態）。探索木の根の状態なので prepare でも消さない
+        self.home = None
+        # 探索木・遷移表・結果の更新は複数ベンチから並列に呼ばれることがある
+        self.lock = threading.RLock()
+        self.settle = settle  # 操作前・バグチェック後に待つ秒数
+        self.stop_on_ng = True  # 探索木は BUG / OK しか使わないので ng が出たら残りのカテゴリは待たない
+        self.finish = False
+        # Planner.ExecutionPlanner を渡すと毎回のリセットの代わりに共通の接頭辞を使い回す
+        self.planner = planner
+        if planner is not None:
+            planner.lock = self.lock
+        self.pending = []  # 検証済みで未実行の候補経路（planner 使用時のみ）
+        # ResultSink.ResultWriter を渡すと結果を results に溜めずにイテレーションごとに書き出す
+        self.sink = sink
+        self.sink_start = 0  # 今回の実行のレコードが始まるファイル位置
 
-    def logger(self, msg):
+    def logger(self, msg, *args):
+        # 引数は出力する時だけ整形する
         if self.log:
-            print(msg)
+            log.info(msg, *args)
 
     def print_results(self):
-        for r in self.results:
-            PRINT(r)
+        if self.sink is None:
+            for r in self.results:
+                log.debug(r)
+            return
+        for record in read_results(self.sink.path, start=self.sink_start):
+            if record["steps"] is not None:
+                log.debug("%04d;%s;%s", record["i"], ";".join(record["steps"]),
+                          "BUG" if record["bug"] else "OK")
 
-    def run(self):
+    def prepare(self):
+        """探索開始前の初期化"""
         self.results = []
-        i = 0
         self.finish = False
+        self.pending = []
+        if self.planner is not None:
+            self.planner.prepare(self.model)
+        if self.sink is not None:
+            self.sink_start = self.sink.tell()
+            self.sink.write({"type": "run", "engine": "tree", "time": time.time(),
+                             "max_iter": self.max_iter})
+
+    def run(self):
+        self.prepare()
+        i = 0
         while i < self.max_iter and not self.finish:
             i += 1
-            self.logger(f"=== START iter={i+1} ===")
-            self.logger("resetting")
+            self.run_iteration(self.model, i)
+        if self.sink is not None:
+            self.sink.flush()
 
-            # 1. 状態のリセット
-            self.model.reset()
+    def run_iteration(self, model, i):
+        """1イテレーション（リセット -> 経路決定 -> 操作 -> バグチェック -> フィードバック）を
+        model 上で実行する。ParallelSearchEngine からはベンチごとのスレッドで呼ばれる"""
+        self.logger("=== START iter=%d ===", i + 1)
+        self.logger("resetting")
+        record = self.start_record(model)
 
-            self.logger("=== Start act ===")
-            # 2. 操作手順の決定
-            while True:
-                # 見つかるまで探索
-                path = self.tree.explore_once()
-                if path is None:
-                    # freezeに突き当たったらやり直し
-                    if self.tree.root.all_children_is_freezed():
-                        PRINT("Searched All Route!!")
-                        self.finish = True
-                        break
-                    else:
-                        PRINT("Try to other Route")
-                        continue
-                else:
-                    # 実行のシミュレーション。実行不可な場合はやり直し
-                    result = self._action(path, simulate=True)
-                    if result is not None:
-                        break
-                    else:
-                        PRINT("Try to other Route")
-                        continue
-            if self.finish:
-                break
-            SLEEP(1)
-
-            # 3. 操作
-            result = self._action(path)
+        # 1. 状態のリセット（planner があれば経路を決めてから必要な分だけ戻す）
+        if self.planner is None and not self.reset(model):
+            # 探索木は home から検証するので、別の状態からは実行しない
+            self.logger("=== END iter=%d not at the start state, skip ===", i + 1)
+            return
+
+        self.logger("=== Start act ===")
+        # 2. 操作手順の決定（実行可能な経路が見つかるまで探索）
+        path = self.plan(model)
+        if path is None:
+            return
+        if record is not None:
+            record["state_before"] = dict(self.start_state(model))
+        start = 0
+        if self.planner is not None:
+            start = self.planner.begin(model, list(self.steps(path)))
+            if start is None:
+                self.release(path)
+                self.logger("=== END iter=%d not at the start state, skip ===", i + 1)
+                return
+        self.pause(model)
+
+        # 3. 操作
+        result_bug = None
+        try:
+            result = self._action(path, model=model, start=start)
             if result is not None:
                 self.logger("== check bug triggered ==")
                 # 4. バグ発生チェック
-                result_bug = self.model.check_bug_triggered()
-                # ログ出力
-                r = f"{i+1:04};" + ";".join(result) + (";BUG" if result_bug else ";OK")
-                self.logger(r)
-                self.results.append(r)
-
-                # 探索木のUpdate
-                self.tree.feedback(result_bug)
-                SLEEP(1)
-                self.logger(f"=== END iter={i+1} result_bug={result_bug} ===")
+                result_bug = model.check_bug_triggered(stop_on_ng=self.stop_on_ng)
+        finally:
+            self.release(path)
+
+        self.end_record(model, record)
+        self.complete(i, path, result, result_bug, record)
+        if result is not None:
+            self.pause(model)
+
+    def start_record(self, model):
+        """sink に書くイテレーションの記録を始める（sink が無ければ None）"""
+        if self.sink is None:
+            return None
+        return {"time": time.time(), "elapsed": time.perf_counter(), "clock": model.clock.now()}
+
+    def end_record(self, model, record):
+        """start_record からの経過時間と操作後の状態を記録に加える"""
+        if record is None:
+            return
+        record["elapsed"] = time.perf_counter() - record["elapsed"]
+        record["clock"] = model.clock.now() - record["clock"]
+        record["state_after"] = dict(model.get_current_state())
+
+    def pause(self, model):
+        """操作前・バグチェック後の待ち（settle 秒）"""
+        SLEEP(self.settle, model.clock)
+
+    def plan(self, model):
+        """次に実行する経路を決めて virtual loss を付ける。探索済みなら None"""
+        with self.lock:
+            path = self._next_path(model)
+            if path is None:
+                return None
+            # 実行中の経路は他のベンチが選びにくくする（virtual loss）
+            self.tree.add_virtual_loss(path)
+        return path
+
+    def steps(self, path):
+        """path の各ノードを ("start" | "act" | "wait", 値, ノード) として返す"""
+        for node in path:
+            if node.name == "START":
+                yield "start", node.name, node
+            elif node.is_action:
+                yield "act", node.name, node
             else:
-                self.logger(f"=== END iter={i+1} skip feedback ===")
+                yield "wait", int(node.name), node
 
-    def _action(self, path, simulate=False):
-        result = []
+    def release(self, path):
+        """plan で付けた virtual loss を外す"""
+        with self.lock:
+            self.tree.remove_virtual_loss(path)
+
+    def complete(self, i, path, result, result_bug, record=None):
+        """操作結果を記録して探索木にフィードバックする（result が None ならスキップ）
+        @param record: start_record / end_record で作った時間・状態（sink に一緒に書く）
+        """
+        is_bug = None
+        if result is not None:
+            is_bug = any(v == "ng" for v in result_bug.values())
+            # ログ出力
+            r = f"{i+1:04};" + ";".join(result) + (";BUG" if is_bug else ";OK")
+            self.logger("%s", r)
+
+            # 探索木のUpdate
+            with self.lock:
+                if self.sink is None:
+                    self.results.append(r)
+                self.tree.feedback(is_bug, path, [k for k, v in result_bug.items() if v == "ng"])
+            self.logger("=== END iter=%d result_bug=%s ===", i + 1, result_bug)
+        else:
+            self.logger("=== END iter=%d skip feedback ===", i + 1)
+        if self.sink is not None:
+            self.sink.write({"type": "iteration", "i": i + 1,
+                             "path": [node.name for node in path], "steps": result,
+                             "bug": is_bug, "verdict": result_bug, **(record or {})})
+
+    def start_state(self, model):
+        """経路の開始状態 home（最初のリセット直後の状態。planner 使用時は planner の home）"""
+        if self.planner is not None:
+            return self.planner.home(model)
+        if self.home is None:
+            self.home = dict(model.get_current_state())
+        return self.home
+
+    def reset(self, model):
+        """model をリセットして home に戻す（Model.reset は reset_acts を実行するだけで、
+        状態機械を初期状態に戻すとは限らない）
+        @retval: home に着いたか
+        """
+        model.reset()
+        route = self.route_home(model)
+        if route:
+            mark = model.history_mark()
+            for act in route:
+                if not model.perform_action(act):
+                    break
+            # 移動に使った操作はバグチェックの履歴に残さない
+            model.rewind_history(mark)
+        return self.is_home(model)
+
+    def route_home(self, model):
+        """リセット直後の model を home に戻す操作名のリスト
+        （home にいれば []、遷移表が無い・戻れなければ None）"""
+        home = self.start_state(model)
+        state = model.get_current_state()
+        if state == home:
+            return []
+        with self.lock:
+            if not self._ensure_table(model):
+                return None
+            space = self.table.space
+            try:
+                src = self.table.add(space.encode(state))
+                dst = self.table.add(space.encode(home))
+            except KeyError:
+                return None
+            acts = self.table.shortest_path(src, dst)
+        return None if acts is None else [space.actions[a] for a in acts]
+
+    def is_home(self, model):
+        """model が home にいるか（いなければ警告を出す）。遷移表を使わなければ
+        各経路をそのまま実機で検証するので、開始状態は問わない"""
+        state = model.get_current_state()
+        if not self.use_table or state == self.start_state(model):
+            return True
+        log.warning("not at the start state after reset: %s", dict(state))
+        return False
+
+    def _ensure_table(self, model):
+        """遷移表を（モデルのアクションが変わっていれば作り直して）用意する。使えなければ False"""
+        if self.use_table and (self.table is None or
+                               self.table.space.actions != list(model.get_acts())):
+            self._build_table(model)
+        return self.use_table
+
+    def _build_table(self, model):
+        """経路の一括検証に使う遷移表（モデルの実行可能アクションのみ）"""
+        sm = model.sm
+        if not StateSpace.fits(sm.get_all_states()):
+            log.warning("state space too large for the transition table; "
+                        "validating paths one by one")
+            self.use_table = False
+            return
+        space = StateSpace(sm.get_all_states(), sm.compiled_actions, model.get_acts(),
+                           sm.auto_transitions)
+        self.table = TransitionTable(space)
+
+    def _next_path(self, model=None):
+        """候補経路を探索木から取り出して一括検証し、実行可能な経路を返す。
+        planner が無ければ1本から始め、全て実行不可だった場合だけ batch_size まで倍々に増やす
+        （余った経路は使わないので、探索木から余分に取り出さない）。planner があれば
+        共通の接頭辞を選べるよう batch_size 本取り出し、余りを pending に残す。
+        全経路を探索済みなら finish を立てて None を返す"""
+        model = model or self.model
+        if self._ensure_table(model):
+            space = self.table.space
+            start = self.table.add(space.encode(self.start_state(model)))
+        root = self.tree.root
+        if self.use_table and root.table is None and not root.expanded:
+            # home（reset が毎回戻す状態）から、実行可能なアクションだけを木に展開する
+            root.table = self.table
+            root.state = start
+        if self.pending:
+            # 前回の検証で余った経路のうち、このベンチの直前の経路と接頭辞を最も共有するもの
+            path = self.pending.pop(self.planner.pick(model, self.pending))
+            self.tree.path = path
+            return path
+        chunk = self.batch_size if self.planner is not None else 1
+        while True:
+            candidates = []
+            drawn = set()
+            while len(candidates) < chunk:
+                path = self.tree.explore_once()
+                if path is not None:
+                    if tuple(path) in drawn:
+                        # フィードバックまで探索木は同じ経路を返しやすいので、重複が出たら打ち切る
+                        break
+                    drawn.add(tuple(path))
+                    candidates.append(path)
+                elif self.tree.root.all_children_is_freezed():
+                    break
+                else:
+                    # freezeに突き当たったらやり直し
+                    log.debug("Try to other Route")
+            if not candidates:
+                log.debug("Searched All Route!!")
+                self.finish = True
+                return None
+
+            act_nodes = [[node for node in path if node.name != "START" and node.is_action]
+                         for path in candidates]
+            waits = [self._waits(path) for path in candidates]
+            if self.use_table:
+                paths = np.full((len(candidates), max(len(n) for n in act_nodes)), -1,
+                                dtype=np.int64)
+                wait_arr = np.zeros(paths.shape)
+                for i, nodes in enumerate(act_nodes):
+                    paths[i, :len(nodes)] = [space.action_index.get(n.name, -2) for n in nodes]
+                    wait_arr[i, :len(nodes)] = waits[i]
+                feasible, first_fail = self.table.check_paths(start, paths, wait_arr)
+            else:
+                feasible, first_fail = self._simulate_paths(model, act_nodes, waits)
+
+            chosen = None
+            for path, nodes, ok, fail in zip(candidates, act_nodes, feasible, first_fail):
+                if not ok:
+                    self.reject(path, nodes[fail])
+                elif chosen is None:
+                    chosen = path
+                elif self.planner is not None:
+                    self.pending.append(path)
+            if self.pending:
+                self.planner.order(self.pending)
+            if chosen is not None:
+                self.tree.path = chosen
+                return chosen
+            chunk = min(chunk * 2, self.batch_size)
+            log.debug("Try to other Route")
+
+    @staticmethod
+    def _waits(path):
+        """path の各アクションの直後の待機秒数（待機ノードが無ければ 0）"""
+        waits = []
         for node in path:
             if node.name == "START":
+                continue
+            if node.is_action:
+                waits.append(0)
+            elif waits:
+                waits[-1] = float(node.name)
+        return waits
+
+    def _simulate_paths(self, model, act_nodes, waits):
+        """check_paths と同じ結果を状態機械の上で1本ずつ求める（遷移表を作れない場合）"""
+        acts = set(model.get_acts())
+        sm = model.sm
+        feasible, first_fail = [], []
+        for nodes, path_waits in zip(act_nodes, waits):
+            state = self.start_state(model)
+            elapsed = None
+            fail = None
+            for i, (node, wait) in enumerate(zip(nodes, path_waits)):
+                if node.name not in acts:
+                    fail = i
+                    break
+                nxt, rejected = simulate_actions(sm.compiled_actions, state, [node.name])
+                if rejected is not None:
+                    fail = i
+                    break
+                elapsed = reset_elapsed(state, nxt, elapsed)
+                state = nxt
+                if wait > 0:
+                    settled = simulate_wait(sm.auto_transitions, state, wait, elapsed)
+                    if settled is None:
+                        # 待機後の状態が決まらないので、ここから先は実機に任せる
+                        break
+                    state, elapsed = settled
+            feasible.append(fail is None)
+            first_fail.append(-1 if fail is None else fail)
+        return feasible, first_fail
+
+    def _simulate(self, path, model=None):
+        """path が実行可能かを状態機械の上だけで確認する（実機操作・待機なし）"""
+        model = model or self.model
+        act_nodes = [node for node in path if node.name != "START" and node.is_action]
+        failed = model.simulate([node.name for node in act_nodes])
+        if failed is not None:
+            self.reject(path, act_nodes[failed])
+            return None
+        return [f"act: {node.name}" for node in path if node.name == "START" or node.is_action]
+
+    def reject(self, path, node):
+        """実行できない node 以下を探索対象から外す"""
+        self.logger("force_freeze %s", node.name)
+        with self.lock:
+            node.force_freeze()
+            for p in path[::-1]:
+                p.try_to_freeze()
+            # 子ノード削除（失敗ノード以下は探索しない）
+            node.children = []
+            # 余っていた候補経路が消したノードを含むかもしれないので捨てる
+            self.pending = []
+
+    def _action(self, path, simulate=False, model=None, start=0):
+        """path を実行する。先頭 start ステップは planner で実行済みとして記録だけする"""
+        model = model or self.model
+        if simulate:
+            return self._simulate(path, model)
+        result = []
+        for i, (kind, value, node) in enumerate(self.steps(path)):
+            if i < start:
+                result.append(f"act: {value}" if kind != "wait" else f"wait: {node.name}")
+                continue
+            if kind == "start":
                 # 開始ノード
-                result.append(f"act: {node.name}")
-            elif node.is_action:
+                result.append(f"act: {value}")
+            elif kind == "act":
                 # 行動ノード
-                if self.model.perform_action(node.name, simulate=simulate):
-                    result.append(f"act: {node.name}")
+                if model.perform_action(value):
+                    result.append(f"act: {value}")
                 else:
                     # 行動失敗（遷移不可な経路など）の場合はFeedbackスキップ
                     result = None
-                    self.logger(f"force_freeze {node.name}")
-                    node.force_freeze()
-                    for p in path[::-1]:
-                        p.try_to_freeze()
-                    # 子ノード削除（失敗ノード以下は探索しない）
-                    node.children = []
+                    self.reject(path, node)
                     break
-            elif not simulate:
+            else:
                 # 待機ノード
-                self.model.wait(int(node.name))
+                model.wait(value)
                 result.append(f"wait: {node.name}")
+            if self.planner is not None:
+                self.planner.record(model, node)
         return result
 
     def save_root_to_pickle(self, name="root.pickle"):
         with open(name, mode="wb") as f:
             pickle.dump(self.root, f)
-        PRINT(f"saved to {name}")
+        log.debug("saved to %s", name)
 
@@ -0,0 +1,179 @@
+from pathlib import Path
+import sys
+import asyncio
+
+# パス設定
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.ModelAsync import AsyncModel
+
+
+class AsyncSearchEngine:
+    """SearchEngine のイテレーションを asyncio で実行する
+
+    engine は Engine.SearchEngine / EngineStateBase.SearchEngine のどちらでもよい。
+    経路決定・フィードバックは engine の plan / steps / reject / release / complete を使い、
+    操作・待機・バグチェックだけを await する。engine に planner があればリセットの代わりに
+    planner の route / arrive で接頭辞を使い回す（移動・リセットの操作も await する）。ベンチ（Model）ごとにコルーチンを1本立てるので、
+    1つのイベントループ（1スレッド）で多数のベンチやシミュレーションを同時に回せる。
+    """
+    def __init__(self, engine, models, max_iter=None, settle=None):
+        """
+        @param engine: 探索エンジン（engine.model は経路決定前の初期化に使う）
+        @param models: ベンチごとの Model / AsyncModel（それぞれ専用の Actor / Monitor を持つこと）
+        @param max_iter: 全ベンチ合計のイテレーション数（省略時は engine.max_iter）
+        @param settle: 実時間のベンチで操作前・バグチェック後に待つ秒数（省略時は engine.settle）
+        """
+        self.engine = engine
+        self.models = [m if isinstance(m, AsyncModel) else AsyncModel(m) for m in models]
+        self.max_iter = max_iter if max_iter is not None else engine.max_iter
+        self.settle = settle if settle is not None else engine.settle
+        self.iteration = 0
+
+    def _next_iteration(self):
+        # コルーチンの切り替えは await でしか起きないのでロック不要
+        if self.iteration >= self.max_iter or self.engine.finish:
+            return None
+        self.iteration += 1
+        return self.iteration
+
+    async def run_iteration(self, model, i):
+        """1イテレーション（リセット -> 経路決定 -> 操作 -> バグチェック -> フィードバック）"""
+        engine = self.engine
+        engine.logger("=== START iter=%d ===", i)
+        engine.logger("resetting")
+        record = engine.start_record(model.model)
+
+        # 1. 状態のリセット（planner があれば経路を決めてから必要な分だけ戻す）
+        planner = engine.planner
+        if planner is None or not planner.is_home_known(model.model):
+            # planner.home に同期版の reset をさせない。home に戻れなければ実行しない
+            if not await self._reset(model):
+                engine.logger("=== END iter=%d not at the start state, skip ===", i)
+                return
+
+        engine.logger("=== Start act ===")
+        # 2. 操作手順の決定
+        path = engine.plan(model.model)
+        if path is None:
+            return
+        if record is not None:
+            record["state_before"] = dict(engine.start_state(model.model))
+        start = 0
+        if planner is not None:
+            start = await self._begin(model, list(engine.steps(path)))
+            if start is None:
+                engine.release(path)
+                engine.logger("=== END iter=%d not at the start state, skip ===", i)
+                return
+        await self._pause(model)
+
+        # 3. 操作
+        result_bug = None
+        try:
+            result = await self._action(model, path, start)
+            if result is not None:
+                engine.logger("== check bug triggered ==")
+                # 4. バグ発生チェック
+                result_bug = await model.check_bug_triggered(stop_on_ng=engine.stop_on_ng)
+        finally:
+            engine.release(path)
+
+        engine.end_record(model.model, record)
+        engine.complete(i, path, result, result_bug, record)
+        if result is not None:
+            await self._pause(model)
+
+    async def _pause(self, model):
+        if model.real_time:
+            await asyncio.sleep(self.settle)
+        else:
+            # 仮想時計のベンチは同期版と同じ待ち方にする
+            self.engine.pause(model.model)
+
+    async def _begin(self, model, steps):
+        """planner.begin の非同期版
+        @retval: 実行済みとして飛ばせる先頭のステップ数。home に戻れなかったら None
+        """
+        planner = self.engine.planner
+        n, route = planner.route(model.model, steps)
+        if route is not None:
+            for edge in route:
+                if not await model.perform_action(edge.action):
+                    break
+            n = planner.arrive(model.model, n, route)
+            if n is not None:
+                return n
+        if not await self._reset(model):
+            return None
+        return 0
+
+    async def _reset(self, model):
+        """planner.reset / engine.reset の非同期版（リセットして home に戻す）
+        @retval: home に着いたか
+        """
+        engine = self.engine
+        planner = engine.planner
+        await model.reset()
+        if planner is None and not hasattr(engine, "route_home"):
+            # home を持たない engine（EngineStateBase）はリセットだけ
+            return True
+        route = (planner or engine).route_home(model.model)
+        if route:
+            mark = model.model.history_mark()
+            for action in route:
+                if not await model.perform_action(action):
+                    break
+            # 移動に使った操作はバグチェックの履歴に残さない
+            model.model.rewind_history(mark)
+        if planner is not None:
+            return planner.mark_home(model.model)
+        return engine.is_home(model.model)
+
+    async def _action(self, model, path, start=0):
+        """path を実行する。先頭 start ステップは planner で実行済みとして記録だけする"""
+        planner = self.engine.planner
+        result = []
+        for i, (kind, value, node) in enumerate(self.engine.steps(path)):
+            if i < start:
+                result.append(f"act: {value}" if kind != "wait" else f"wait: {value}")
+                continue
+            if kind == "start":
+                # 開始ノード
+                result.append(f"act: {value}")
+            elif kind == "act":
+                # 行動ノード
+                if await model.perform_action(value):
+                    result.append(f"act: {value}")
+                else:
+                    # 行動失敗（遷移不可な経路など）の場合はFeedbackスキップ
+                    self.engine.reject(path, node)
+                    return None
+            else:
+                # 待機ノード
+                await model.wait(value)
+                result.append(f"wait: {value}")
+            if planner is not None:
+                planner.record(model.model, node)
+        return result
+
+    async def _worker(self, model):
+        while True:
+            i = self._next_iteration()
+            if i is None:
+                return
+            await self.run_iteration(model, i)
+
+    async def run_async(self):
+        """既存のイベントループ上で実行する場合はこちらを await する"""
+        self.engine.prepare()
+        self.iteration = 0
+        await asyncio.gather(*(self._worker(model) for model in self.models))
+        if self.engine.sink is not None:
+            self.engine.sink.flush()
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    def print_results(self):
+        self.engine.print_results()
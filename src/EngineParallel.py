@@ -0,0 +1,64 @@
+from pathlib import Path
+import sys
+import threading
+
+# パス設定
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+
+class ParallelSearchEngine:
+    """複数のテストベンチ（Model）で SearchEngine のイテレーションを並列に実行する
+
+    engine は Engine.SearchEngine / EngineStateBase.SearchEngine のどちらでもよい。
+    ベンチごとにスレッドを1本立て、各スレッドが engine.run_iteration(model, i) を繰り返す。
+    探索木（グラフ）は engine 内で共有し、経路の選択・フィードバックは engine.lock で排他する。
+    実行中の経路には virtual loss を付けるので、各ベンチが同じ枝ばかり選ぶことはない。
+    """
+    def __init__(self, engine, models, max_iter=None):
+        """
+        @param engine: 探索エンジン（engine.model は経路決定前の初期化に使う）
+        @param models: ベンチごとの Model（それぞれ専用の Actor / Monitor を持つこと）
+        @param max_iter: 全ベンチ合計のイテレーション数（省略時は engine.max_iter）
+        """
+        self.engine = engine
+        self.models = list(models)
+        self.max_iter = max_iter if max_iter is not None else engine.max_iter
+        self.iteration = 0
+        self._lock = threading.Lock()
+        self._errors = []
+
+    def _next_iteration(self):
+        with self._lock:
+            if self.iteration >= self.max_iter or self.engine.finish or self._errors:
+                return None
+            self.iteration += 1
+            return self.iteration
+
+    def _worker(self, model):
+        try:
+            while True:
+                i = self._next_iteration()
+                if i is None:
+                    return
+                self.engine.run_iteration(model, i)
+        except Exception as e:
+            with self._lock:
+                self._errors.append(e)
+
+    def run(self):
+        self.engine.prepare()
+        self.iteration = 0
+        self._errors = []
+        threads = [threading.Thread(target=self._worker, args=(model,), daemon=True)
+                   for model in self.models]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if self.engine.sink is not None:
+            self.engine.sink.flush()
+        if self._errors:
+            raise self._errors[0]
+
+    def print_results(self):
+        self.engine.print_results()
@@ -6,19 +6,27 @@ import json
 import datetime
 import os
 import time
+import threading
 
-def SLEEP(duration):
-    """秒数待機"""
-    if 0:
-        time.sleep(duration)
+# パス設定
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.ResultSink import read_bugs
+from src.Log import get_logger
+
+log = get_logger("EngineStateBase")
 
-def PRINT(msg):
-    """ログ出力"""
+def SLEEP(duration, clock=None):
+    """秒数待機（clock を渡すとその時計で待つ。TestModel なら仮想時間が進むだけ）"""
     if 0:
-        print(msg)
+        if clock is not None:
+            clock.sleep(duration)
+        else:
+            time.sleep(duration)
 
 class SearchEngine:
-    def __init__(self, model, graph, max_iter=100, seed=None, log=True, diagnose_bugs=True):
+    def __init__(self, model, graph, max_iter=100, seed=None, log=True, diagnose_bugs=True, settle=1,
+                 planner=None, sink=None):
         self.model = model
         self.graph = graph
         self.max_iter = max_iter
@@ -26,90 +34,226 @@ class SearchEngine:
         if seed is not None:
             random.seed(seed)
         self.diagnose_bugs = diagnose_bugs
-        self.result_bug_path = []
+        self.result_bug_path = []  # {"i": イテレーション, "path": [アクション名]}
+        self.coverage = []  # イテレーションごとの graph.coverage()
+        # グラフ・結果の更新は複数ベンチから並列に呼ばれることがある
+        self.lock = threading.RLock()
+        self.settle = settle  # 操作前・バグチェック後に待つ秒数
+        self.stop_on_ng = False  # グラフはカテゴリごとの結果を使うので全カテゴリを待つ
+        self.finish = False
+        # Planner.ExecutionPlanner を渡すと毎回のリセットの代わりに共通の接頭辞を使い回す
+        self.planner = planner
+        if planner is not None:
+            planner.lock = self.lock
+        # ResultSink.ResultWriter を渡すと結果・カバレッジをメモリに溜めずにイテレーションごとに書き出す
+        self.sink = sink
+        self.sink_start = 0  # 今回の実行のレコードが始まるファイル位置
 
-    def logger(self, *args):
+    def logger(self, msg, *args):
+        # 引数は出力する時だけ整形する
         if self.log:
-            print(*args)
+            log.info(msg, *args)
 
-    def run(self):
+    def prepare(self):
+        """探索開始前の初期化（グラフ構築）"""
         self.result_bug_path = []
-        i = 0
+        self.coverage = []
         self.finish = False
-        self.graph.build_graph()
+        self.graph.build_graph(reset_acts=self.model.reset_acts)
+        if self.planner is not None:
+            self.planner.prepare(self.model)
+        if self.sink is not None:
+            self.sink_start = self.sink.tell()
+            self.sink.write({"type": "run", "engine": "graph", "time": time.time(),
+                             "max_iter": self.max_iter})
+
+    def run(self):
+        self.prepare()
+        i = 0
         while i < self.max_iter and not self.finish:
             i += 1
-            self.logger(f"=== START iter={i} ===")
-            self.logger("resetting")
+            self.run_iteration(self.model, i)
+        if self.sink is not None:
+            self.sink.flush()
 
-            # 1. 状態のリセット
-            self.model.reset()
+    def run_iteration(self, model, i):
+        """1イテレーション（リセット -> 経路決定 -> 操作 -> バグチェック -> フィードバック）を
+        model 上で実行する。ParallelSearchEngine からはベンチごとのスレッドで呼ばれる"""
+        self.logger("=== START iter=%d ===", i)
+        self.logger("resetting")
+        record = self.start_record(model)
 
-            self.logger("=== Start act ===")
-            # 2. 操作手順の決定
-            state = self.model.get_current_state()
-            path = self.graph.explore_once(state)
-            if path is None:
-                PRINT("Searched All Route!!")
-                break
-            SLEEP(1)
+        # 1. 状態のリセット（planner があれば経路を決めてから必要な分だけ戻す）
+        if self.planner is None:
+            model.reset()
 
-            # 3. 操作
-            result = self._action(path)
+        self.logger("=== Start act ===")
+        # 2. 操作手順の決定
+        path = self.plan(model)
+        if path is None:
+            return
+        if record is not None:
+            record["state_before"] = dict(self.start_state(model))
+        start = 0
+        if self.planner is not None:
+            start = self.planner.begin(model, list(self.steps(path)))
+            if start is None:
+                self.release(path)
+                self.logger("=== END iter=%d not at the start state, skip ===", i)
+                return
+        self.pause(model)
+
+        # 3. 操作
+        result_bug = None
+        try:
+            result = self._action(path, model=model, start=start)
             if result is not None:
                 self.logger("== check bug triggered ==")
                 # 4. バグ発生チェック
-                result_bug = self.model.check_bug_triggered()
-                for k, v in result_bug.items():
-                    if v == "ng":
-                        self.result_bug_path.append({
-                            "i": i,
-                            "path": path
-                        })
-                        break
-                # ログ出力
-                r = f"{i:04};" + ";".join(result) + (";BUG" if result_bug else ";OK")
-                self.logger(r)
-
-                # 探索木のUpdate
-                self.graph.feedback(path, result_bug)
-                SLEEP(1)
-                self.logger(f"=== END iter={i} result_bug={result_bug} ===")
-            else:
-                self.logger(f"=== END iter={i} skip feedback ===")
+                result_bug = model.check_bug_triggered(stop_on_ng=self.stop_on_ng)
+        finally:
+            self.release(path)
 
-    def _action(self, path, simulate=False):
-        result = []
+        self.end_record(model, record)
+        self.complete(i, path, result, result_bug, record)
+        if result is not None:
+            self.pause(model)
+
+    def start_record(self, model):
+        """sink に書くイテレーションの記録を始める（sink が無ければ None）"""
+        if self.sink is None:
+            return None
+        return {"time": time.time(), "elapsed": time.perf_counter(), "clock": model.clock.now()}
+
+    def end_record(self, model, record):
+        """start_record からの経過時間と操作後の状態を記録に加える"""
+        if record is None:
+            return
+        record["elapsed"] = time.perf_counter() - record["elapsed"]
+        record["clock"] = model.clock.now() - record["clock"]
+        record["state_after"] = dict(model.get_current_state())
+
+    def pause(self, model):
+        """操作前・バグチェック後の待ち（settle 秒）"""
+        SLEEP(self.settle, model.clock)
+
+    def plan(self, model):
+        """次に実行する経路を決めて virtual loss を付ける。探索済みなら None"""
+        state = self.start_state(model)
+        with self.lock:
+            path = self.graph.explore_once(state)
+            if path is None:
+                log.debug("Searched All Route!!")
+                self.finish = True
+                return None
+            # 実行中の経路は他のベンチが選びにくくする（virtual loss）
+            self.graph.add_virtual_loss(path)
+        return path
+
+    def start_state(self, model):
+        """経路の開始状態（planner 使用時はリセット直後の状態）"""
+        if self.planner is not None:
+            return self.planner.home(model)
+        return model.get_current_state()
+
+    def steps(self, path):
+        """path の各エッジを ("start" | "act" | "wait", 値, エッジ) として返す"""
         for edge in path:
             if edge.action == "START":
-                # 開始ノード
-                result.append(f"act: {edge.action}")
+                yield "start", edge.action, edge
             elif edge.is_action:
+                yield "act", edge.action, edge
+            else:
+                yield "wait", int(edge.action), edge
+
+    def reject(self, path, edge):
+        """実行できなかった操作を記録する（グラフは状態機械から作っているので変更しない）"""
+        self.logger("force_freeze %s", edge.action)
+
+    def release(self, path):
+        """plan で付けた virtual loss を外す"""
+        with self.lock:
+            self.graph.remove_virtual_loss(path)
+
+    def complete(self, i, path, result, result_bug, record=None):
+        """操作結果を記録してグラフにフィードバックする（result が None ならスキップ）
+        @param record: start_record / end_record で作った時間・状態（sink に一緒に書く）
+        """
+        is_bug = cov = None
+        if result is not None:
+            is_bug = any(v == "ng" for v in result_bug.values())
+            # ログ出力
+            r = f"{i:04};" + ";".join(result) + (";BUG" if is_bug else ";OK")
+            self.logger("%s", r)
+
+            # 探索木のUpdate
+            with self.lock:
+                if is_bug and self.sink is None:
+                    self.result_bug_path.append({
+                        "i": i,
+                        "path": [e.action for e in path]
+                    })
+                self.graph.feedback(path, result_bug)
+                cov = dict(self.graph.coverage(), i=i)
+                if self.sink is None:
+                    self.coverage.append(cov)
+            self.logger("coverage: edges=%d/%d pairs=%d/%d actions=%d",
+                        cov["edges"], cov["edges_total"], cov["pairs"], cov["pairs_total"],
+                        cov["actions"])
+            self.logger("=== END iter=%d result_bug=%s ===", i, result_bug)
+        else:
+            self.logger("=== END iter=%d skip feedback ===", i)
+        if self.sink is not None:
+            self.sink.write({"type": "iteration", "i": i, "path": [e.action for e in path],
+                             "steps": result, "bug": is_bug, "verdict": result_bug,
+                             "coverage": cov, **(record or {})})
+
+    def _action(self, path, simulate=False, model=None, start=0):
+        """path を実行する。先頭 start ステップは planner で実行済みとして記録だけする"""
+        model = model or self.model
+        if simulate:
+            # 状態機械の上だけで確認する（実機操作・待機なし）
+            acts = [edge.action for edge in path if edge.is_action and edge.action != "START"]
+            if model.simulate(acts) is not None:
+                return None
+            return [f"act: {edge.action}" for edge in path if edge.is_action]
+        result = []
+        for i, (kind, value, edge) in enumerate(self.steps(path)):
+            if i < start:
+                result.append(f"act: {value}" if kind != "wait" else f"wait: {edge.action}")
+                continue
+            if kind == "start":
+                # 開始ノード
+                result.append(f"act: {value}")
+            elif kind == "act":
                 # 行動ノード
-                if self.model.perform_action(edge.action, simulate=simulate):
-                    result.append(f"act: {edge.action}")
+                if model.perform_action(value):
+                    result.append(f"act: {value}")
                 else:
                     # 行動失敗（遷移不可な経路など）の場合はFeedbackスキップ
                     result = None
-                    self.logger(f"force_freeze {edge.action}")
+                    self.reject(path, edge)
                     break
-            elif not simulate:
+            else:
                 # 待機ノード
-                self.model.wait(int(edge.action))
+                model.wait(value)
                 result.append(f"wait: {edge.action}")
+            if self.planner is not None:
+                self.planner.record(model, edge)
         return result
 
     def print_results(self):
-        print(f"=== BUG num={len(self.result_bug_path)} ===")
-        for p in self.result_bug_path:
-            tmp = []
-            for e in p["path"]:
-                tmp.append(e.action)
-            print(f"{p['i']:04} {'->'.join(tmp)}")
-        print(f"=== BUG END ===")
+        if self.sink is None:
+            bugs = self.result_bug_path
+        else:
+            bugs = list(read_bugs(self.sink.path, start=self.sink_start))
+        log.info("=== BUG num=%d ===", len(bugs))
+        for p in bugs:
+            log.info("%04d %s", p["i"], "->".join(p["path"]))
+        log.info("=== BUG END ===")
 
     def save_root_to_pickle(self, name="root.pickle"):
         with open(name, mode="wb") as f:
             pickle.dump(self.graph.graph, f)
-        PRINT(f"saved to {name}")
+        log.debug("saved to %s", name)
 
@@ -1,11 +1,15 @@
 import random
 import math
+import sys
+from pathlib import Path
+import numpy as np
 
+# パス設定
+sys.path.append(str(Path(__file__).resolve().parent.parent))
 
-def PRINT(msg):
-    """ログ出力"""
-    if 0:
-        print(msg)
+from src.Log import get_logger, DEBUG
+
+log = get_logger("ExplorerActbase")
 
 class Count:
     def __init__(self):
@@ -22,38 +26,335 @@ class Count:
     def ok_rate(self):
         return (self.ok / self.total) if self.total > 0 else 0.0
 
-class ExplorerNode:
-    def __init__(self, name, is_action, acts=None,
-                 wait_range=(1, 3, 1), probability=1.0,
-                 probability_limit=(0.1, 0.9),
-                 freeze_count=2, path_hist=None):
-
-        self.name = name
-        self.is_action = is_action  # 行動か、待機か
-        self.children = []
-        self.probability = probability
-        self.expanded = False  # 初回展開済みか
-        self.count = Count()   # 検索回数
-        self.probability_limit = probability_limit  # 分岐確率のLimit
+class NodeStore:
+    """探索木のノードを並列の型付き配列で保持するストア
+
+    ノード i の各フィールドは配列の i 番目に入る。兄弟ノードは連続領域に確保するので、
+    子ノードは first_child[i] から n_children[i] 個。パスは parent を辿って復元する。
+    分岐確率は正規化前の重み weight と、親ごとの正規化係数 scale の積で表す
+    （正規化のたびに scale を兄弟の weight に畳み込み、scale は 1 に戻す）。親ごとに子の重みの合計と
+    Freezeされていない子の数も持ち、フィードバックを O(深さ) で反映できるようにする。
+    acts / wait_range などの共通設定はストアに1つだけ持つ。
+    """
+    FIELDS = {
+        "label": (np.int32, -1),            # labels 内のノード名 index
+        "is_action": (np.bool_, False),     # 行動か、待機か
+        "parent": (np.int32, -1),
+        "first_child": (np.int32, -1),
+        "n_children": (np.int32, 0),
+        "expanded": (np.bool_, False),      # 初回展開済みか
+        "weight": (np.float64, 0.0),        # 分岐確率（正規化前）
+        "scale": (np.float64, 1.0),         # 子ノードの分岐確率の正規化係数
+        "weight_sum": (np.float64, 0.0),    # 子ノードの weight の合計
+        "active_children": (np.int32, 0),   # Freezeされていない子ノード数
+        "total": (np.int64, 0),             # 試行回数
+        "ok": (np.int64, 0),                # OK（バグなし）
+        "ng": (np.int64, 0),                # NG（バグあり）
+        "freezed": (np.bool_, False),       # Freezeされたか
+        "last_probability": (np.float64, -1.0),  # Freeze時の分岐確率
+        "state": (np.int32, -1),            # TransitionTable のローカル index（-1: 追跡なし）
+        "visits": (np.int64, 0),            # Freezeされていない子ノードの試行回数の合計
+        "inflight": (np.int32, 0),          # 実行中（フィードバック待ち）の経路数
+    }
+
+    def __init__(self, acts=None, wait_range=(1, 3, 1), probability_limit=(0.1, 0.9),
+                 freeze_count=2, root_hist=None, table=None, capacity=64):
         self.acts = acts if acts is not None else []  # 行動
         self.wait_range = wait_range  # Waitの範囲
-
         if len(wait_range) == 3:
             interval = wait_range[2]
         else:
             interval = 1
         self.wait = list(range(wait_range[0], wait_range[1] + 1, interval))
-
+        self.probability_limit = probability_limit  # 分岐確率のLimit
         self.freeze_count = freeze_count  # Freezeするカウント
-        self.freezed = False              # Freezeされたか
-        self.last_probability = -1        # Freeze時の分岐確率
+        self.root_hist = list(root_hist) if root_hist else []  # ルートより前の履歴
+        self.table = table
+
+        self.labels = []
+        self.label_index = {}
+        # カテゴリごとの NG 回数（列はフィードバックで初めて NG になったカテゴリから順に足す）
+        self.categories = []
+        self.category_index = {}
+        self.ng_by_category = np.zeros((capacity, 0), dtype=np.int64)
+        self.n = 0
+        for field, (dtype, fill) in self.FIELDS.items():
+            setattr(self, field, np.full(capacity, fill, dtype=dtype))
+
+    def label_id(self, name):
+        idx = self.label_index.get(name)
+        if idx is None:
+            idx = self.label_index[name] = len(self.labels)
+            self.labels.append(name)
+        return idx
+
+    def category_id(self, name):
+        """バグのカテゴリの ng_by_category の列 index（無ければ列を足す）"""
+        idx = self.category_index.get(name)
+        if idx is None:
+            idx = self.category_index[name] = len(self.categories)
+            self.categories.append(name)
+            column = np.zeros((len(self.ng_by_category), 1), dtype=np.int64)
+            self.ng_by_category = np.hstack([self.ng_by_category, column])
+        return idx
+
+    def alloc(self, count):
+        """count 個の連続したノードを確保し、先頭 index を返す"""
+        capacity = len(self.label)
+        if self.n + count > capacity:
+            while capacity < self.n + count:
+                capacity *= 2
+            for field, (dtype, fill) in self.FIELDS.items():
+                arr = np.full(capacity, fill, dtype=dtype)
+                arr[:self.n] = getattr(self, field)[:self.n]
+                setattr(self, field, arr)
+            arr = np.zeros((capacity, len(self.categories)), dtype=np.int64)
+            arr[:self.n] = self.ng_by_category[:self.n]
+            self.ng_by_category = arr
+        first = self.n
+        self.n += count
+        return first
+
+    def add_children(self, parent, names, is_action, probability, states):
+        """parent の子ノードをまとめて追加する"""
+        first = self.alloc(len(names))
+        sl = slice(first, first + len(names))
+        self.label[sl] = [self.label_id(name) for name in names]
+        self.is_action[sl] = is_action
+        self.parent[sl] = parent
+        self.weight[sl] = probability
+        self.state[sl] = states
+        self.first_child[parent] = first
+        self.n_children[parent] = len(names)
+        self.active_children[parent] = len(names)
+        self.weight_sum[parent] = probability * len(names)
+        self.scale[parent] = 1.0
+
+    def clear_children(self, idx):
+        self.n_children[idx] = 0
+        self.active_children[idx] = 0
+        self.weight_sum[idx] = 0.0
+
+    def children(self, idx):
+        first = int(self.first_child[idx])
+        return range(first, first + int(self.n_children[idx]))
+
+    def child_slice(self, idx):
+        first = int(self.first_child[idx])
+        return slice(first, first + int(self.n_children[idx]))
+
+    def set_total(self, idx, total):
+        parent = self.parent[idx]
+        if parent >= 0 and not self.freezed[idx]:
+            self.visits[parent] += total - self.total[idx]
+        self.total[idx] = total
+
+    def set_freezed(self, idx, freezed):
+        if bool(self.freezed[idx]) == bool(freezed):
+            return
+        self.freezed[idx] = freezed
+        parent = self.parent[idx]
+        if parent >= 0:
+            self.visits[parent] += -self.total[idx] if freezed else self.total[idx]
+            self.active_children[parent] += -1 if freezed else 1
+
+    def probability(self, idx):
+        parent = self.parent[idx]
+        if parent >= 0:
+            return float(self.weight[idx] * self.scale[parent])
+        return float(self.weight[idx])
+
+    def set_probability(self, idx, probability):
+        parent = self.parent[idx]
+        if parent < 0:
+            self.weight[idx] = probability
+            return
+        weight = probability / self.scale[parent]
+        self.weight_sum[parent] += weight - self.weight[idx]
+        self.weight[idx] = weight
+
+    def normalize(self, idx):
+        """idx の子ノードの分岐確率の合計が1になるよう正規化する
+        scale だけを更新し続けると weight が際限なく小さく（大きく）なって inf / nan になるので、
+        兄弟の weight をまとめて割り直し、合計も差分の積み重ねではなく取り直す
+        """
+        sl = self.child_slice(idx)
+        total = self.weight[sl].sum()
+        if total > 0:
+            self.weight[sl] /= total
+            self.weight_sum[idx] = 1.0
+            self.scale[idx] = 1.0
+
+    def check_probabilities(self, tol=1e-9):
+        """子ノードの分岐確率が有限でないか、合計が1（全てFreezeなら0）でない親ノードの index を返す"""
+        bad = []
+        for idx in np.flatnonzero(self.n_children[:self.n] > 0):
+            p = self.weight[self.child_slice(idx)] * self.scale[idx]
+            total = p.sum()
+            if not np.all(np.isfinite(p)) or not (abs(total - 1) <= tol or total == 0):
+                bad.append(int(idx))
+        return bad
+
+
+class NodeCount:
+    """NodeStore 上の試行回数のビュー（Count と同じ属性）"""
+    __slots__ = ("store", "idx")
+
+    def __init__(self, store, idx):
+        self.store = store
+        self.idx = idx
+
+    total = property(lambda self: int(self.store.total[self.idx]),
+                     lambda self, v: self.store.set_total(self.idx, v))
+    ok = property(lambda self: int(self.store.ok[self.idx]),
+                  lambda self, v: self.store.ok.__setitem__(self.idx, v))
+    ng = property(lambda self: int(self.store.ng[self.idx]),
+                  lambda self, v: self.store.ng.__setitem__(self.idx, v))
+
+    def reset(self):
+        self.total = self.ok = self.ng = 0
+        self.store.ng_by_category[self.idx] = 0
+
+    def bug_rate(self):
+        return (self.ng / self.total) if self.total > 0 else 0.0
+
+    def ok_rate(self):
+        return (self.ok / self.total) if self.total > 0 else 0.0
 
-        if path_hist is None:
-            self.path_hist = []
-        else:
-            self.path_hist = list(path_hist)
 
-        self.path_hist.append(self.name)
+class ExplorerNode:
+    """NodeStore 上のノードの薄いビュー
+
+    ExplorerNode(...) で生成するとそのノードをルートとする新しい NodeStore を作る。
+    子ノードは同じストア上のビューとして返す。
+    """
+    __slots__ = ("store", "idx")
+
+    def __init__(self, name, is_action, acts=None,
+                 wait_range=(1, 3, 1), probability=1.0,
+                 probability_limit=(0.1, 0.9),
+                 freeze_count=2, path_hist=None, table=None, state=None):
+        self.store = NodeStore(acts, wait_range, probability_limit, freeze_count,
+                               path_hist, table)
+        self.idx = self.store.alloc(1)
+        self.store.label[self.idx] = self.store.label_id(name)
+        self.store.is_action[self.idx] = is_action
+        self.store.weight[self.idx] = probability
+        self.state = state
+
+    @classmethod
+    def view(cls, store, idx):
+        node = cls.__new__(cls)
+        node.store = store
+        node.idx = idx
+        return node
+
+    def __eq__(self, other):
+        return isinstance(other, ExplorerNode) and self.store is other.store and self.idx == other.idx
+
+    def __hash__(self):
+        return hash((id(self.store), self.idx))
+
+    def __repr__(self):
+        return f"ExplorerNode({'-'.join(self.path_hist)})"
+
+    # ---- フィールド ----
+    @property
+    def name(self):
+        return self.store.labels[self.store.label[self.idx]]
+
+    @property
+    def is_action(self):
+        return bool(self.store.is_action[self.idx])
+
+    @property
+    def parent(self):
+        parent = int(self.store.parent[self.idx])
+        return ExplorerNode.view(self.store, parent) if parent >= 0 else None
+
+    @property
+    def children(self):
+        return [ExplorerNode.view(self.store, i) for i in self.store.children(self.idx)]
+
+    @children.setter
+    def children(self, children):
+        # 子ノードの削除のみ対応（失敗ノード以下は探索しない）
+        if children:
+            raise ValueError("children can only be cleared")
+        self.store.clear_children(self.idx)
+
+    @property
+    def probability(self):
+        return self.store.probability(self.idx)
+
+    @probability.setter
+    def probability(self, v):
+        self.store.set_probability(self.idx, v)
+
+    @property
+    def n_children(self):
+        return int(self.store.n_children[self.idx])
+
+    @property
+    def expanded(self):
+        return bool(self.store.expanded[self.idx])
+
+    @expanded.setter
+    def expanded(self, v):
+        self.store.expanded[self.idx] = v
+
+    @property
+    def freezed(self):
+        return bool(self.store.freezed[self.idx])
+
+    @freezed.setter
+    def freezed(self, v):
+        self.store.set_freezed(self.idx, v)
+
+    @property
+    def last_probability(self):
+        return float(self.store.last_probability[self.idx])
+
+    @last_probability.setter
+    def last_probability(self, v):
+        self.store.last_probability[self.idx] = v
+
+    @property
+    def state(self):
+        state = int(self.store.state[self.idx])
+        return state if state >= 0 else None
+
+    @state.setter
+    def state(self, v):
+        self.store.state[self.idx] = -1 if v is None else v
+
+    @property
+    def count(self):
+        return NodeCount(self.store, self.idx)
+
+    @property
+    def path_hist(self):
+        names = []
+        i = self.idx
+        while i >= 0:
+            names.append(self.store.labels[self.store.label[i]])
+            i = int(self.store.parent[i])
+        return self.store.root_hist + names[::-1]
+
+    # ---- ツリー共通の設定 ----
+    acts = property(lambda self: self.store.acts)
+    wait_range = property(lambda self: self.store.wait_range)
+    wait = property(lambda self: self.store.wait)
+    probability_limit = property(lambda self: self.store.probability_limit)
+    freeze_count = property(lambda self: self.store.freeze_count)
+
+    @property
+    def table(self):
+        return self.store.table
+
+    @table.setter
+    def table(self, table):
+        self.store.table = table
 
     def get_bug_rate(self):
         return self.count.bug_rate()
@@ -69,7 +370,7 @@ class ExplorerNode:
         # exploit = 観測されたバグ率（高いほど注目）
         exploit = self.get_bug_rate()
         explore = c * math.sqrt(math.log(parent_total_visits) / (1 + self.count.total))
-        # PRINT(f"UCB {self.name}: exploit={exploit:.3f}, explore={explore:.3f}")
+        # log.debug(f"UCB {self.name}: exploit={exploit:.3f}, explore={explore:.3f}")
         return exploit + explore
 
     def expand(self):
@@ -78,35 +379,56 @@ class ExplorerNode:
         self.expanded = True
 
         if not self.is_action:  # 行動ノードを展開
-            p = 1 / len(self.acts) if self.acts else 1.0
-            for act in self.acts:
-                self.children.append(
-                    ExplorerNode(
-                        name=act,
-                        is_action=True,
-                        acts=self.acts,
-                        wait_range=self.wait_range,
-                        probability=p,
-                        probability_limit=self.probability_limit,
-                        freeze_count=self.freeze_count,
-                        path_hist=self.path_hist.copy()
-                    )
-                )
+            acts = [(act, self.next_state(act)) for act in self.acts]
+            if self.table is not None and self.state is not None:
+                # required を満たさないアクションは展開しない
+                acts = [(act, state) for act, state in acts if state is not None]
+            p = 1 / len(acts) if acts else 1.0
+            self.store.add_children(self.idx, [act for act, _ in acts], True, p,
+                                    [-1 if state is None else state for _, state in acts])
         else:  # 待機ノードを展開
             p = 1 / len(self.wait) if self.wait else 1.0
-            for wait in self.wait:
-                self.children.append(
-                    ExplorerNode(
-                        name=str(wait),
-                        is_action=False,
-                        acts=self.acts,
-                        wait_range=self.wait_range,
-                        probability=p,
-                        probability_limit=self.probability_limit,
-                        freeze_count=self.freeze_count,
-                        path_hist=self.path_hist.copy()
-                    )
-                )
+            if self.table is not None and self.state is not None:
+                # 待機中の自動遷移を反映する（結果が決まらなければ状態を追跡しない）
+                elapsed = self.elapsed()
+                states = [self.table.after_wait(self.state, wait, elapsed)[0] for wait in self.wait]
+            else:
+                states = self.store.state[self.idx]
+            self.store.add_children(self.idx, [str(wait) for wait in self.wait], False, p, states)
+
+    def elapsed(self):
+        """このノードの状態で、自動遷移を持つカテゴリごとにその値に入ってからの経過秒数の範囲
+        （StateSpace.after_wait の elapsed）。根からの経路のアクションと待機をたどって求める"""
+        store = self.store
+        chain = []
+        i = self.idx
+        while i >= 0:
+            chain.append(i)
+            i = int(store.parent[i])
+        space = self.table.space
+        elapsed = None
+        prev = int(store.state[chain[-1]])
+        for i in reversed(chain[:-1]):
+            state = int(store.state[i])
+            if prev < 0 or state < 0:
+                return None
+            if store.is_action[i]:
+                elapsed = space.reset_elapsed(int(self.table.state_ids[prev]),
+                                              int(self.table.state_ids[state]), elapsed)
+            else:
+                _, elapsed = self.table.after_wait(prev, float(store.labels[store.label[i]]), elapsed)
+            prev = state
+        return elapsed
+
+    def next_state(self, act):
+        """act 実行後の状態（実行できない、または状態を追跡していなければ None）"""
+        if self.table is None or self.state is None:
+            return None
+        a = self.table.space.action_index.get(act)
+        if a is None:
+            return None
+        dst = self.table.row(self.state)[a]
+        return int(dst) if dst >= 0 else None
 
 
     def mul_probability(self, v):
@@ -130,41 +452,51 @@ class ExplorerNode:
     def ok_count_inc(self):
         self.count.ok += 1
 
-    def ng_count_inc(self):
+    def ng_count_inc(self, categories=()):
+        """@param categories: NG になったカテゴリの列 index（NodeStore.category_id）"""
         self.count.ng += 1
+        self.store.ng_by_category[self.idx, list(categories)] += 1
 
     def try_to_freeze(self):
         """指定回数探索後、かつ子ノードがすべてFreeze済ならFreezeする"""
         if self.freezed:
             return True
-        elif (len(self.children) > 0 and self.all_children_is_freezed()) or \
-             (len(self.children) == 0 and self.count.total >= self.freeze_count):
+        elif (self.n_children > 0 and self.all_children_is_freezed()) or \
+             (self.n_children == 0 and self.count.total >= self.freeze_count):
             self.last_probability = self.probability
             self.freezed = True
-            PRINT(f"{'-'.join(self.path_hist)} is freezed. "
-                  f"NG ratio:{self.count.ng/self.count.total:.2f}")
+            if log.isEnabledFor(DEBUG):
+                log.debug("%s is freezed. NG ratio:%.2f",
+                          "-".join(self.path_hist), self.count.bug_rate())
             return True
         else:
             return False
 
     def force_freeze(self):
-        """強制的にFreezeする"""
+        """強制的にFreezeする（残りの兄弟の分岐確率は合計1に正規化し直す）"""
         self.probability = 0
         self.freezed = True
+        parent = self.store.parent[self.idx]
+        if parent >= 0:
+            self.store.normalize(parent)
 
     def is_freezed(self):
         return self.freezed
 
     def all_children_is_freezed(self):
-        return all(c.is_freezed() for c in self.children)
+        return self.store.active_children[self.idx] == 0
+
+    def normalize_children(self):
+        self.store.normalize(self.idx)
 
 class ExplorerTree:
     def __init__(self, root: 'ExplorerNode', max_depth: int = 10,
                  update_prob_inc=1.5, update_prob_dec=0.5,
                  update_prob_method="mul",
-                 selection_method="probability",  # "probability" | "ucb" | "epsilon_greedy"
+                 selection_method="probability",  # "probability" | "ucb" | "epsilon_greedy" | "thompson"
                  ucb_c=1.0,
-                 epsilon=0.1):
+                 epsilon=0.1,
+                 thompson_prior=(1.0, 1.0)):
         self.root = root
         self.path = None
         self.max_depth = max_depth
@@ -175,6 +507,8 @@ class ExplorerTree:
         self.selection_method = selection_method
         self.ucb_c = ucb_c
         self.epsilon = epsilon
+        self.thompson_prior = thompson_prior  # カテゴリごとのバグ率の事前分布 Beta(a, b)
+        self.rng = None  # random のシードから作る（探索エンジンの seed で再現できるように）
 
     def explore_once(self):
         """操作手順を決定"""
@@ -187,18 +521,23 @@ class ExplorerTree:
             if not current.expanded:
                 current.expand()
 
-            if (len(current.children) == 0) or current.all_children_is_freezed():
-                PRINT(f"{'-'.join(current.path_hist)} has no children or all freezed.")
+            if current.n_children == 0 or current.all_children_is_freezed():
+                if log.isEnabledFor(DEBUG):
+                    log.debug("%s has no children or all freezed.", "-".join(current.path_hist))
                 # 探索打ち切り
                 if current.all_children_is_freezed():
                     current.force_freeze()
                 return None
 
             # 分岐確率に基づいて子ノードを選択
-            for c in current.children:
-                PRINT(f"  child {c.name} p={c.probability:.3f} freezed={c.freezed} total={c.count.total} bug_rate={c.get_bug_rate():.3f}")
-            current = self.choose_child(current.children)
-            PRINT(f"-> choose {current.name} (p={current.probability:.3f})")
+            debug = log.isEnabledFor(DEBUG)
+            if debug:
+                for c in current.children:
+                    log.debug("  child %s p=%.3f freezed=%s total=%d bug_rate=%.3f",
+                              c.name, c.probability, c.freezed, c.count.total, c.get_bug_rate())
+            current = self.choose_child(current)
+            if debug:
+                log.debug("-> choose %s (p=%.3f)", current.name, current.probability)
             path.append(current)
 
         # pathを逆にたどりFreezeできるところはFreezeする
@@ -208,84 +547,117 @@ class ExplorerTree:
         self.path = path
         return self.path
 
-    def choose_by_random(self, children):
-        children = [c for c in children if not c.is_freezed()]
-        return random.choice(children)
+    # 子ノードの選択は NodeStore の連続領域（兄弟ノード）に対する配列演算で行う。
+    # 各メソッドは (store, 子ノードの slice, Freezeされていない子の index 配列) を受け取り、
+    # 選んだノードの index を返す。
+    def choose_by_random(self, store, sl, active):
+        return int(active[random.randrange(len(active))])
 
-    def choose_by_probability(self, children):
-        children = [c for c in children if not c.is_freezed()]
-        total = sum(max(0.0, c.probability) for c in children) or 1.0
+    # 実行中の経路（virtual loss）はバグなしの試行として扱い、同じ枝に集中しないようにする
+    def choose_by_probability(self, store, sl, active):
+        p = store.weight[active] * store.scale[store.parent[sl.start]] / (1 + store.inflight[active])
+        total = float(np.maximum(p, 0.0).sum()) or 1.0
         r = random.uniform(0, total)
-        upto = 0.0
-        for child in children:
-            upto += child.probability
-            if upto >= r:
-                return child
-        return children[-1]
-
-    def choose_by_ucb(self, children):
-        children = [c for c in children if not c.is_freezed()]
-        parent_total = sum(c.count.total for c in children) or 1
-        # 未訪問の子があれば優先的に選ぶ（UCB が高くなる）
-        best = max(children, key=lambda c: c.ucb_score(parent_total, c=self.ucb_c))
-        return best
-
-    def choose_epsilon_greedy(self, children):
-        children = [c for c in children if not c.is_freezed()]
+        i = int(np.searchsorted(np.cumsum(p), r, side="left"))
+        return int(active[min(i, len(active) - 1)])
+
+    def choose_by_ucb(self, store, sl, active):
+        parent = store.parent[sl.start]
+        parent_total = max(int(store.visits[parent] + store.inflight[parent]), 1)
+        total = store.total[active] + store.inflight[active]
+        # exploit = 観測されたバグ率、explore = 未訪問ほど大きい
+        exploit = np.divide(store.ng[active], total, out=np.zeros(len(active)), where=total > 0)
+        explore = self.ucb_c * np.sqrt(math.log(parent_total) / (1 + total))
+        return int(active[np.argmax(exploit + explore)])
+
+    def choose_epsilon_greedy(self, store, sl, active):
         if random.random() < self.epsilon:
-            return random.choice(children)
+            return self.choose_by_random(store, sl, active)
+        # exploitation: 最大バグ率を選ぶ
+        total = store.total[active] + store.inflight[active]
+        rate = np.divide(store.ng[active], total, out=np.zeros(len(active)), where=total > 0)
+        return int(active[np.argmax(rate)])
+
+    def choose_by_thompson(self, store, sl, active):
+        """子ノード x カテゴリのバグ率の事後分布 Beta(a + ng, b + total - ng) をまとめて1回ずつ引き、
+        いずれかのカテゴリの値が最大の子を選ぶ（実行中の経路は ok として数える）
+        最初の ng までは試行回数の少ない子を選びやすいだけなので、最初のバグまでの反復回数は
+        probability / ucb より少なくはならない（差が出るのはバグが出た後の再現回数）"""
+        if self.rng is None:
+            self.rng = np.random.default_rng(random.getrandbits(64))
+        a, b = self.thompson_prior
+        if store.categories:
+            ng = store.ng_by_category[active]
         else:
-            # exploitation: 最大バグ率を選ぶ
-            return max(children, key=lambda c: c.get_bug_rate())
-
-    def choose_child(self, children):
-        if not children:
+            # まだどのカテゴリも NG になっていない
+            ng = np.zeros((len(active), 1), dtype=np.int64)
+        tried = (store.total[active] + store.inflight[active])[:, None]
+        sample = self.rng.beta(a + ng, b + tried - ng)
+        return int(active[np.argmax(sample.max(axis=1))])
+
+    def choose_child(self, node):
+        """node の子ノードから selection_method に従って1つ選ぶ
+        （子ノードのリストを渡した場合はその親ノードの子から選ぶ）"""
+        if isinstance(node, list):
+            if not node:
+                return None
+            node = node[0].parent
+        store = node.store
+        sl = store.child_slice(node.idx)
+        active = np.flatnonzero(~store.freezed[sl]) + sl.start
+        if len(active) == 0:
             return None
         if self.selection_method == "random":
-            return self.choose_by_random(children)
-        elif self.selection_method == "probability":
-            return self.choose_by_probability(children)
+            idx = self.choose_by_random(store, sl, active)
         elif self.selection_method == "ucb":
-            return self.choose_by_ucb(children)
+            idx = self.choose_by_ucb(store, sl, active)
         elif self.selection_method == "epsilon_greedy":
-            return self.choose_epsilon_greedy(children)
-        else:
-            return self.choose_by_probability(children)
-
-    def feedback(self, result: bool):
-        self._update_count(result)
+            idx = self.choose_epsilon_greedy(store, sl, active)
+        elif self.selection_method == "thompson":
+            idx = self.choose_by_thompson(store, sl, active)
+        else:  # "probability"
+            idx = self.choose_by_probability(store, sl, active)
+        return ExplorerNode.view(store, idx)
+
+    def feedback(self, result: bool, path=None, categories=None):
+        """path（省略時は最後に explore_once した経路）の結果を反映する
+        @param categories: NG になったカテゴリ名のリスト（thompson のカテゴリごとの事後分布に使う）
+        """
+        if path is not None:
+            self.path = path
+        self._update_count(result, categories)
         if result:
             self.update_probability(self.update_prob_inc, self.update_prob_method)
         else:
             self.update_probability(self.update_prob_dec, self.update_prob_method)
 
+    def add_virtual_loss(self, path, n=1):
+        """実行中の path を選択時に考慮する（フィードバック後に remove_virtual_loss で戻す）"""
+        # ルートも含めて加算し、親の inflight が子の合計と一致するようにする（UCB の親試行回数に使う）
+        for node in path:
+            node.store.inflight[node.idx] += n
+
+    def remove_virtual_loss(self, path, n=1):
+        self.add_virtual_loss(path, -n)
+
     def update_probability(self, value=0.5, method="mul"):
-        current = self.root
-        for p in self.path[1:]:  # 最初のSTARTノードは飛ばす
-            if not current.all_children_is_freezed():
-                for c in current.children:
-                    if p.name == c.name:
-                        if method == "add":
-                            c.add_probability(value)
-                        elif method == "mul":
-                            c.mul_probability(value)
-                        # 合計1になるよう正規化
-                        total = sum(cc.probability for cc in current.children)
-                        for x in current.children:
-                            x.probability /= total
-                        current = c
-                        break
-
-    def _update_count(self, result: bool):
+        for node in self.path[1:]:  # 最初のSTARTノードは飛ばす
+            parent = node.parent
+            if parent.all_children_is_freezed():
+                break
+            if method == "add":
+                node.add_probability(value)
+            elif method == "mul":
+                node.mul_probability(value)
+            # 合計1になるよう正規化
+            parent.normalize_children()
+
+    def _update_count(self, result: bool, categories=None):
         """pathで通ったnodeのCountを+1する"""
-        current = self.root
-        for p in self.path:
-            for c in current.children:
-                if p.name == c.name:
-                    if not result:
-                        c.ok_count_inc()
-                    else:
-                        c.ng_count_inc()
-                    c.total_count_inc()
-                    current = c
-                    break
+        cols = [self.root.store.category_id(c) for c in categories or []]
+        for node in self.path[1:]:
+            if not result:
+                node.ok_count_inc()
+            else:
+                node.ng_count_inc(cols)
+            node.total_count_inc()
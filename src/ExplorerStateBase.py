@@ -1,25 +1,36 @@
 import random, sys
+import numpy as np
+import hashlib
+import json
 from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 from src.StateMachine import StateMachine
-from itertools import product
+from src.StateSpace import StateSpace, TransitionTable
+from src.Log import get_logger, lazy
+from collections import deque
+from collections.abc import Mapping
+
+log = get_logger("ExplorerStateBase")
 
 
 
 class GraphNode:
-    def __init__(self, name, state):
+    def __init__(self, name, state, id=None):
         self.name = name
         self.state = state  # 状態の辞書
+        self.id = id  # state_id
         self.edges = {}  # action -> GraphEdge
 
 class GraphEdge:
-    def __init__(self, action, dst):
+    def __init__(self, action, dst, dst_id=None):
         self.action = action
         self.dst = dst
+        self.dst_id = dst_id
         self.trials = 0
         self.freezed = False
         self.results = {}  # {"audio": {"ok": 0, "ng": 0}, "video": {...}}
         self.is_action = True
+        self.inflight = 0  # 実行中（フィードバック待ち）の経路数
 
     def record_result(self, result: dict):
         self.trials += 1
@@ -39,8 +50,43 @@ class GraphEdge:
         self.freezed = False
 
 
+class GraphView(Mapping):
+    """遷移表の上に GraphNode / GraphEdge を必要になった時だけ作る state_name -> GraphNode の辞書"""
+    def __init__(self, table):
+        self.table = table  # TransitionTable
+        self._nodes = {}    # ローカル index -> GraphNode
+
+    def node(self, idx):
+        """ローカル index の GraphNode（未展開なら展開してから作る）"""
+        node = self._nodes.get(idx)
+        if node is None:
+            space = self.table.space
+            sid = int(self.table.state_ids[idx])
+            node = GraphNode(self.table.name(idx), space.decode(sid), idx)
+            for a, dst in enumerate(self.table.row(idx)):
+                if dst >= 0:
+                    action = space.actions[a]
+                    node.edges[action] = GraphEdge(action, self.table.name(int(dst)), int(dst))
+            self._nodes[idx] = node
+        return node
+
+    def __getitem__(self, name):
+        idx = self.table.lookup(self.table.space.encode_name(name))
+        if idx is None:
+            raise KeyError(name)
+        return self.node(idx)
+
+    def __iter__(self):
+        for idx in range(len(self.table)):
+            yield self.table.name(idx)
+
+    def __len__(self):
+        return len(self.table)
+
+
 class Explorer:
-    def __init__(self, actions, max_steps=5, freeze_limit=3, log=True):
+    def __init__(self, actions, max_steps=5, freeze_limit=3, log=True,
+                 cache_dir=".graph_cache", method="random", thompson_prior=(1.0, 1.0)):
         self.sm = StateMachine(log=False)
         self.actions = actions
         self.graph = {}  # state_name -> GraphNode
@@ -49,41 +95,65 @@ class Explorer:
         self.total_trials = 0
         self.feedback_count = 0
         self.log = log
-
-    def build_graph(self):
-        states = self.sm.get_all_states()
-
-        keys = list(states.keys())
-
-        for values in product(*(states[k] for k in keys)):
-            state = dict(zip(keys, values))
-            name = self.sm.convert_state_to_str(state)
-            node = self.graph.setdefault(name, GraphNode(name, state))
-            for a in self.actions:
-                self.sm.set_all_states(state.copy())
-                if self.sm.trigger(a) is False:
-                    continue
-                expected_state = self.sm.get_expected_state()
-                dst = self.sm.convert_state_to_str(expected_state)
-                node.edges[a] = GraphEdge(a, dst)
-            # print(f"状態: {state}, 遷移可能アクション: {[e.action for e in node.edges.values()]}")
-        # init_state から到達可能なノードだけに絞る
+        self.cache_dir = cache_dir  # None ならキャッシュしない
+        self.method = method  # "random" | "least_tried" | "weighted" | "coverage" | "thompson"
+        self.thompson_prior = thompson_prior  # カテゴリごとのバグ率の事前分布 Beta(a, b)
+        self.categories = []  # フィードバックで見たカテゴリ（Thompson sampling の列）
+        self.rng = None  # random のシードから作る（探索エンジンの seed で再現できるように）
+        self.covered_edges = 0  # 1回以上実行したエッジ数
+        self.covered_pairs = set()  # 連続して実行したエッジの組 (edge, next_edge)
+        self.executed_actions = 0  # フィードバックした経路の操作数の合計
+
+    def build_graph(self, reset_acts=None, limit_depth=False):
+        """初期状態（と reset_acts 実行後の状態）から到達可能な状態だけを展開する
+        @param reset_acts: Model.reset で実行するアクション。実行後の状態も起点にする
+        @param limit_depth: True なら max_steps の深さで展開を止める（残りは必要時に展開）
+        """
+        self.space = StateSpace(self.sm.get_all_states(), self.sm.compiled_actions, self.actions)
+        max_depth = self.max_steps if limit_depth else None
+
+        cache_path = None
+        if self.cache_dir is not None:
+            key = self.cache_key(reset_acts, max_depth)
+            cache_path = Path(self.cache_dir) / f"{key[:16]}.graph"
+            table = TransitionTable.load(cache_path, self.space, key)
+            if table is not None:
+                self.table = table
+                self.graph = GraphView(self.table)
+                self.logger("Graph loaded from %s with %d nodes", cache_path, len(self.graph))
+                if table.next_hop is None and table.build_next_hop():
+                    # 次ホップ表の無い古いキャッシュは表を付けて書き直す
+                    table.save(cache_path, key)
+                return
+
+        self.table = TransitionTable(self.space)
         init_state = self.sm.get_init_state()
-        init_name = self.sm.convert_state_to_str(init_state)
-        reachable = set()
-        to_visit = [init_name]
-        while to_visit:
-            current = to_visit.pop()
-            if current in reachable:
-                continue
-            reachable.add(current)
-            node = self.graph.get(current)
-            if node:
-                for edge in node.edges.values():
-                    if edge.dst not in reachable:
-                        to_visit.append(edge.dst)
-        self.graph = {name: node for name, node in self.graph.items() if name in reachable}
-        self.logger(f"Graph built with {len(self.graph)} nodes")
+        roots = [self.space.encode(init_state)]
+        if reset_acts:
+            state = init_state
+            for a in reset_acts:
+                op_def = self.sm.compiled_actions.get(a)
+                if op_def is not None and op_def.is_allowed(state):
+                    state = op_def.next_state(state)
+            roots.append(self.space.encode(state))
+
+        self.table.build(roots, max_depth)
+        self.table.build_next_hop()
+        self.graph = GraphView(self.table)
+        if cache_path is not None:
+            self.table.save(cache_path, key)
+        self.logger("Graph built with %d nodes", len(self.graph))
+
+    def cache_key(self, reset_acts=None, max_depth=None):
+        """グラフキャッシュのキー（YAMLの内容・アクション一覧・構築条件のハッシュ）"""
+        h = hashlib.sha256()
+        h.update(self.sm.config.digest.encode())
+        h.update(json.dumps([list(self.actions), list(reset_acts or []), max_depth]).encode())
+        return h.hexdigest()
+
+    def get_node(self, state):
+        """状態に対応する GraphNode（未登録の状態はここで追加する）"""
+        return self.graph.node(self.table.add(self.space.encode(state)))
 
 
     def select_edge(self, node, method="random"):
@@ -91,36 +161,56 @@ class Explorer:
         candidates = [e for e in node.edges.values() if not e.freezed]
         if not candidates:
             return None
-        while True:
-            if method == "random":
-                result = random.choice(candidates)
-            elif method == "least_tried":
-                # 試行回数が少ない順
-                result = min(candidates, key=lambda e: e.trials)
-            elif method == "weighted":
-                # 成功率 or 逆試行回数で重みづけ
-                weights = [(1 / (1 + e.trials)) for e in candidates]
-                total = sum(weights)
-                r = random.uniform(0, total)
-                upto = 0
-                for e, w in zip(candidates, weights):
-                    upto += w
-                    if upto >= r:
-                        result = e
-                result = candidates[-1]
-            break
-        result = random.choice(candidates)
+        if method == "least_tried":
+            # 試行回数が少ない順
+            result = min(candidates, key=lambda e: e.trials)
+        elif method == "weighted":
+            # 成功率 or 逆試行回数で重みづけ
+            weights = [(1 / (1 + e.trials)) for e in candidates]
+            result = random.choices(candidates, weights=weights)[0]
+        elif method == "thompson":
+            result = candidates[self.sample_thompson(candidates)]
+        else:
+            result = random.choice(candidates)
         # print(f"{node.name} candidates: {[e.action for e in candidates]} dst: {[e.dst for e in candidates]} result:{result.action}")
         return result
 
-    def logger(self, *args):
+    def sample_thompson(self, candidates):
+        """エッジ x カテゴリのバグ率の事後分布 Beta(a + ng, b + ok) をまとめて1回ずつ引き、
+        いずれかのカテゴリの値が最大のエッジの index を返す（実行中の経路は ok として数える）
+        最初の ng までは試行回数の少ないエッジを選びやすいだけなので、最初のバグまでの反復回数は
+        random より少なくはならない（差が出るのはバグが出た後の再現回数）"""
+        if self.rng is None:
+            self.rng = np.random.default_rng(random.getrandbits(64))
+        a, b = self.thompson_prior
+        cats = self.categories or [None]
+        ng = np.zeros((len(candidates), len(cats)))
+        ok = np.zeros((len(candidates), len(cats)))
+        for i, e in enumerate(candidates):
+            for j, cat in enumerate(cats):
+                res = e.results.get(cat, {})
+                ng[i, j] = res.get("ng", 0)
+                ok[i, j] = res.get("ok", 0) + e.inflight
+        sample = self.rng.beta(a + ng, b + ok)
+        return int(np.argmax(sample.max(axis=1)))
+
+    def logger(self, msg, *args):
+        # 引数は出力する時だけ整形する
         if self.log:
-            print(*args)
-
-    def explore_once(self, state, method="random"):
+            log.info(msg, *args)
+
+    def explore_once(self, state, method=None):
+        method = method or self.method
+        if method == "coverage":
+            path = self.plan_coverage(state)
+            if path:
+                self.total_trials += len(path)
+                self.logger("state: %s, path: %s", state, lazy(lambda: [e.action for e in path]))
+                return path
+            # 到達できる範囲は網羅済み。以降は試行回数の少ないエッジを辿る
+            method = "least_tried"
         path = []
-        name = self.sm.convert_state_to_str(state)
-        cur = self.graph[name]
+        cur = self.get_node(state)
 
         for _ in range(self.max_steps):
             edge = self.select_edge(cur, method=method)
@@ -128,36 +218,123 @@ class Explorer:
                 break
 
             path.append(edge)
-            cur = self.graph[edge.dst]
+            cur = self.graph.node(edge.dst_id)
             self.total_trials += 1
         if len(path) == 0:
             return None
-        self.logger(f"state: {state}, path: {[e.action for e in path]}")
+        self.logger("state: %s, path: %s", state, lazy(lambda: [e.action for e in path]))
         return path
 
-    # StartとGoalを指定して幅有線探索で最短パスを返却
-    def find_shortest_path(self, start_state, goal_state):
-        start_name = self.sm.convert_state_to_str(start_state)
-        goal_name = self.sm.convert_state_to_str(goal_state)
-
-        from collections import deque
-        queue = deque()
-        queue.append((start_name, []))
-        visited = set()
-        visited.add(start_name)
-
+    def coverage_gain(self, prev, edge):
+        """edge を prev の次に実行したときに新しく網羅するエッジ・組の数"""
+        gain = 1 if edge.trials == 0 else 0
+        if prev is not None and (prev, edge) not in self.covered_pairs:
+            gain += 1
+        return gain
+
+    def uncovered_edges(self, node):
+        return sum(1 for e in node.edges.values() if e.trials == 0 and not e.freezed)
+
+    def nearest_gain(self, node, depth, edges_only=False):
+        """node から depth 手以内で、次の1手が新しいエッジか組（edges_only ならエッジのみ）を
+        網羅するノードのうち最も近いものまでのエッジ列（無ければ None）"""
+        queue = deque([(node, [])])
+        visited = {node.id}
         while queue:
-            current_name, path = queue.popleft()
-            if current_name == goal_name:
+            cur, path = queue.popleft()
+            if path and (self.uncovered_edges(cur) if edges_only else
+                         any(self.coverage_gain(path[-1], e)
+                             for e in cur.edges.values() if not e.freezed)):
                 return path
+            if len(path) >= depth:
+                continue
+            for edge in cur.edges.values():
+                if not edge.freezed and edge.dst_id not in visited:
+                    visited.add(edge.dst_id)
+                    queue.append((self.graph.node(edge.dst_id), path + [edge]))
+        return None
+
+    def plan_coverage(self, state):
+        """未実行のエッジと未実行のエッジの組を貪欲に拾う max_steps 以内の経路
+        各手では未実行のエッジを優先し、次に未実行の組、同点なら遷移先に残る未実行エッジが多い方を選ぶ。
+        どのエッジでも増えなければ、次の1手で増えるノード（未実行エッジのあるノードを優先）へ
+        最短で移動する
+        """
+        path = []
+        cur = self.get_node(state)
+        prev = None
+        new = 0
+        # 計画中の経路で網羅する分も数える（同じエッジ・組を1経路で何度も拾わない）
+        planned_edges, planned_pairs = set(), set()
+        while len(path) < self.max_steps:
+            candidates = [e for e in cur.edges.values() if not e.freezed]
+            if not candidates:
+                break
 
-            current_node = self.graph.get(current_name)
-            if current_node:
-                for edge in current_node.edges.values():
-                    if edge.dst not in visited:
-                        visited.add(edge.dst)
-                        queue.append((edge.dst, path + [edge]))
-        return None  # ゴールに到達できない場合
+            def gain(e):
+                new_edge = e.trials == 0 and e not in planned_edges
+                new_pair = prev is not None and (prev, e) not in self.covered_pairs \
+                    and (prev, e) not in planned_pairs
+                return new_edge, new_pair, self.uncovered_edges(self.graph.node(e.dst_id))
+
+            best = max(candidates, key=gain)
+            if any(gain(best)[:2]):
+                steps = [best]
+            else:
+                depth = self.max_steps - len(path) - 1
+                steps = self.nearest_gain(cur, depth, edges_only=True) or \
+                    self.nearest_gain(cur, depth)
+                if steps is None:
+                    break
+            for edge in steps:
+                new += sum(gain(edge)[:2])
+                planned_edges.add(edge)
+                if prev is not None:
+                    planned_pairs.add((prev, edge))
+                path.append(edge)
+                prev = edge
+            cur = self.graph.node(prev.dst_id)
+        if new == 0:
+            # 何も新しく網羅しない経路は返さない
+            return None
+        return path
+
+    def coverage(self):
+        """エッジと連続するエッジの組の網羅状況（構築済みの遷移表に対する割合）"""
+        table = self.table
+        n = len(table)
+        rows = table.next_state[:n][table.expanded[:n]]
+        edges = int((rows >= 0).sum())
+        # 組の総数 = 各エッジの遷移先から出るエッジ数の合計
+        out_degree = (table.next_state[:n] >= 0).sum(axis=1)
+        pairs = int(out_degree[rows[rows >= 0]].sum())
+        return {
+            "edges": self.covered_edges,
+            "edges_total": edges,
+            "pairs": len(self.covered_pairs),
+            "pairs_total": pairs,
+            "actions": self.executed_actions,
+        }
+
+    # StartとGoalを指定して最短パスを返却（遷移表の次ホップ表を辿る）
+    def find_shortest_path(self, start_state, goal_state):
+        src = self.get_node(start_state).id
+        try:
+            dst = self.table.lookup(self.space.encode(goal_state))
+        except KeyError:
+            dst = None
+        if dst is None:
+            return None  # ゴールに到達できない場合
+        acts = self.table.shortest_path(src, dst)
+        if acts is None:
+            return None  # ゴールに到達できない場合
+        path = []
+        node = self.graph.node(src)
+        for a in acts:
+            edge = node.edges[self.space.actions[a]]
+            path.append(edge)
+            node = self.graph.node(edge.dst_id)
+        return path
 
 
     def maybe_unfreeze(self):
@@ -170,14 +347,32 @@ class Explorer:
                     if edge.freezed:
                         edge.unfreeze()
 
+    def add_virtual_loss(self, path, n=1):
+        """実行中の path のエッジを試行中として数える（フィードバック後に remove_virtual_loss で戻す）"""
+        for edge in path:
+            edge.inflight += n
+
+    def remove_virtual_loss(self, path, n=1):
+        self.add_virtual_loss(path, -n)
+
     def feedback(self, path, result: dict):
         """
         Path と結果を受け取り、エッジに反映する
         """
+        for cat in result:
+            if cat not in self.categories:
+                self.categories.append(cat)
+        prev = None
         for edge in path:
             if edge:
+                if edge.trials == 0:
+                    self.covered_edges += 1
                 edge.record_result(result)
+                if prev is not None:
+                    self.covered_pairs.add((prev, edge))
+                prev = edge
 
+        self.executed_actions += len(path)
         self.feedback_count += 1
 
     def export_dot(self, filename="graph", fmt="svg"):
@@ -222,4 +417,4 @@ class Explorer:
 
         # filename は拡張子なしで渡すのが安全
         outpath = dot.render(filename, cleanup=True)
-        print(f"Graph exported to {outpath}")
+        log.info("Graph exported to %s", outpath)
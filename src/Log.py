@@ -0,0 +1,148 @@
+from pathlib import Path
+import sys
+import copy
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+from collections import deque
+
+# パス設定
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+ROOT = "dss"  # このパッケージのロガーはすべて dss.<名前> の下に置く
+
+
+class lazy:
+    """出力する時になって初めて値を作る引数（log.info("%s", lazy(lambda: ...))）"""
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return str(self.func())
+
+
+class StdoutHandler(logging.StreamHandler):
+    """その時点の sys.stdout に書く（contextlib.redirect_stdout で捨てられるように）"""
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class RingBufferHandler(logging.Handler):
+    """直近 capacity 件のレコードを保持する（障害時にあとから読む用）
+    引数はあとから書き換えられることがある（model.bug_state など）ので、
+    メッセージは emit の時点で文字列にしておく
+    """
+    def __init__(self, capacity=1000):
+        super().__init__()
+        self.buffer = deque(maxlen=capacity)
+
+    def emit(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.buffer.append(record)
+
+    def records(self):
+        return list(self.buffer)
+
+    def messages(self):
+        return [record.msg for record in self.buffer]
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコード1行の JSON。extra={"fields": {...}} で渡した値もそのまま入れる"""
+    def format(self, record):
+        event = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        event.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            event["exc"] = self.formatException(record.exc_info)
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+_root = logging.getLogger(ROOT)
+_root.setLevel(INFO)
+_root.propagate = False
+_console = StdoutHandler()
+_console.setFormatter(logging.Formatter("%(message)s"))
+_root.addHandler(_console)
+_ring = RingBufferHandler()
+_root.addHandler(_ring)
+_sink = None  # (QueueHandler, QueueListener)
+
+
+def get_logger(name):
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def ring_buffer():
+    return _ring
+
+
+def configure(level=None, console=None, ring_size=None, jsonl=None):
+    """ログの出力先とレベルを設定する（None の項目は変更しない）
+    @param level: これより低いレベルのイベントは整形もされずに捨てられる
+    @param console: False なら標準出力に出さない
+    @param ring_size: リングバッファの件数
+    @param jsonl: JSON-lines を書き出すファイル（別スレッドで書く）。False なら止める
+    """
+    global _sink
+    if level is not None:
+        _root.setLevel(level)
+    if console is not None:
+        if console and _console not in _root.handlers:
+            _root.addHandler(_console)
+        elif not console:
+            _root.removeHandler(_console)
+    if ring_size is not None:
+        _ring.buffer = deque(_ring.buffer, maxlen=ring_size)
+    if jsonl is not None:
+        close()
+        if jsonl:
+            file_handler = logging.FileHandler(jsonl, encoding="utf-8")
+            file_handler.setFormatter(JsonFormatter())
+            q = queue.SimpleQueue()
+            handler = logging.handlers.QueueHandler(q)
+            listener = logging.handlers.QueueListener(q, file_handler)
+            listener.start()
+            _root.addHandler(handler)
+            _sink = (handler, listener)
+
+
+def close():
+    """JSON-lines の書き込みスレッドを止める（キューに残ったイベントは書き切る）"""
+    global _sink
+    if _sink is not None:
+        handler, listener = _sink
+        _root.removeHandler(handler)
+        listener.stop()
+        for h in listener.handlers:
+            h.close()
+        _sink = None
+
+
+atexit.register(close)
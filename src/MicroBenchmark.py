@@ -0,0 +1,152 @@
+"""探索の頻出処理のマイクロベンチマーク
+
+探索中に実際に呼ばれる CompiledAction.is_allowed / next_state、simulate_actions、
+StateMachine.trigger、TransitionTable.check_paths と Explorer.build_graph を、
+data/config.yaml と規模を大きくした合成設定（Benchmark.make_config）の上で
+個別に計測し、1回あたりの時間を JSON で出力する。
+
+使い方:
+    python -m src.MicroBenchmark --number 20000 --out micro.json
+"""
+from pathlib import Path
+import sys
+import os
+import json
+import random
+import argparse
+import timeit
+import contextlib
+import numpy as np
+
+# パス設定
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.Config import Config
+from src.Clock import VirtualClock
+from src.StateMachine import StateMachine, simulate_actions
+from src.StateSpace import StateSpace, TransitionTable
+from src.ExplorerStateBase import Explorer
+from src.Benchmark import make_config, use_config
+
+# 合成設定の規模（カテゴリ数, 値の数, アクション数, ガードの密度）
+# 到達可能な状態数はおよそ 15 / 140 / 4500 / 30000
+SCALES = [(3, 3, 6, 0.2), (5, 4, 16, 0.2), (7, 4, 32, 0.2), (8, 4, 48, 0.2)]
+
+
+def _walk(sm, length, seed):
+    """初期状態から実行可能なアクションを辿った (状態, アクション) の列"""
+    rng = random.Random(seed)
+    state = dict(sm.get_init_state())
+    steps = []
+    while len(steps) < length:
+        allowed = [a for a, op in sm.compiled_actions.items() if op.is_allowed(state)]
+        if not allowed:
+            state = dict(sm.get_init_state())
+            continue
+        action = rng.choice(allowed)
+        steps.append((state, action))
+        state = sm.compiled_actions[action].next_state(state)
+    return steps
+
+
+def _per_call(stmt, number, repeat):
+    """stmt を number 回実行する計測を repeat 回行い、最速の1回あたりマイクロ秒を返す"""
+    return 1e6 * min(timeit.repeat(stmt, number=number, repeat=repeat)) / number
+
+
+def bench_state_machine(number=10000, repeat=3, seed=0):
+    """現在の設定（Config）の上で各関数を計測する"""
+    sm = StateMachine(log=False, clock=VirtualClock())
+    steps = _walk(sm, 256, seed)
+    states = [s for s, _ in steps]
+    ops = [sm.compiled_actions[a] for _, a in steps]
+    n = len(steps)
+    # 探索木の1経路ぶん（8手）の操作列。_walk の途中から始まるので実行不可の経路も混ざる
+    walks = [[a for _, a in steps[i:i + 8]] for i in range(0, n - 8)]
+    actions = list(sm.compiled_actions)
+    table = None
+    if StateSpace.fits(sm.get_all_states()):
+        space = StateSpace(sm.get_all_states(), sm.compiled_actions, actions)
+        table = TransitionTable(space)
+        start = table.add(space.encode(sm.get_init_state()))
+        paths = np.array([[space.action_index[a] for a in w] for w in walks[:16]], dtype=np.int64)
+        table.check_paths(start, paths)  # 遷移表の展開は計測に含めない
+
+    def trigger():
+        i = trigger.i = (trigger.i + 1) % n
+        state, action = steps[i]
+        sm.ctx.state = dict(state)
+        sm.trigger(action)
+    trigger.i = -1
+
+    def is_allowed():
+        i = is_allowed.i = (is_allowed.i + 1) % n
+        ops[i].is_allowed(states[i])
+    is_allowed.i = -1
+
+    def next_state():
+        i = next_state.i = (next_state.i + 1) % n
+        ops[i].next_state(states[i])
+    next_state.i = -1
+
+    def simulate():
+        i = simulate.i = (simulate.i + 1) % len(walks)
+        simulate_actions(sm.compiled_actions, states[0], walks[i])
+    simulate.i = -1
+
+    result = {}
+    # ログを有効にしている場合の出力は捨て先に流す
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        result["StateMachine.trigger"] = _per_call(trigger, number, repeat)
+    result["CompiledAction.is_allowed"] = _per_call(is_allowed, number, repeat)
+    result["CompiledAction.next_state"] = _per_call(next_state, number, repeat)
+    result["simulate_actions"] = _per_call(simulate, number, repeat)
+    if table is not None:
+        # 16 経路をまとめて検証する1回あたり
+        result["TransitionTable.check_paths"] = _per_call(
+            lambda: table.check_paths(start, paths), max(1, number // 10), repeat)
+    sm.cancel_auto_transitions()
+    return result
+
+
+def bench_build_graph(repeat=3):
+    """Explorer.build_graph（キャッシュなし）の1回あたりミリ秒と状態数"""
+    actions = list(Config().actions)
+    graph = Explorer(actions, log=False, cache_dir=None)
+    per_call = 1e3 * min(timeit.repeat(graph.build_graph, number=1, repeat=repeat))
+    return {"Explorer.build_graph_ms": per_call, "states": len(graph.graph)}
+
+
+def run(number=10000, repeat=3, scales=SCALES, seed=0):
+    results = {}
+    Config()  # data/config.yaml
+    results["config.yaml"] = {**bench_state_machine(number, repeat, seed),
+                              **bench_build_graph(repeat)}
+    for n_categories, n_values, n_actions, guard_density in scales:
+        config = make_config(n_categories=n_categories, n_values=n_values,
+                             n_actions=n_actions, guard_density=guard_density, seed=seed)
+        with use_config(config):
+            results[f"synthetic:{n_categories}x{n_values}x{n_actions}@{guard_density}"] = {
+                **bench_state_machine(number, repeat, seed), **bench_build_graph(repeat)}
+    return {"params": {"number": number, "repeat": repeat, "unit": "us per call",
+                       "scales": [list(s) for s in scales], "seed": seed},
+            "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="StateMachine の頻出処理のマイクロベンチマーク")
+    parser.add_argument("--number", type=int, default=10000, help="1計測あたりの呼び出し回数")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="結果の JSON を書き出すファイル（省略時は標準出力）")
+    args = parser.parse_args(argv)
+    text = json.dumps(run(args.number, args.repeat, seed=args.seed), indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,8 @@
-import re
-import time
 import random
 import sys
 from pathlib import Path
-import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 上位ディレクトリをパスに追加
 sys.path.append(str(Path(__file__).resolve().parent.parent))
@@ -11,19 +10,26 @@ sys.path.append(str(Path(__file__).resolve().parent.parent))
 from src.Actor import MasterActor, DummyActor
 # from VolumeMonitor import VolumeMonitor
 from src.StateMachine import StateMachine
-from src.Monitor.Monitor import Monitor, DummyMonitor
+from src.Clock import Clock, VirtualClock
+from src.Monitor.Monitor import Monitor, POLL_INTERVAL
 from src.Config import Config
+from src.BugIndex import BugPathIndex
+from src.Log import get_logger
+
+log = get_logger("Model")
 
 DEBUG = False
 
 class Model:
-    def __init__(self, custom_actor=[], custom_monitor=[]):
+    def __init__(self, custom_actor=[], custom_monitor=[], clock=None):
         self.total_bug_count = 0
         self.total_act_count = 0
         self.acts = []
         self.reset_acts = []
         self.state = []
-        self.sm = StateMachine()
+        # 待機・自動遷移に使う時計（省略時は実時間）
+        self.clock = clock or Clock()
+        self.sm = StateMachine(clock=self.clock)
         import pkgutil
         import inspect
 
@@ -45,7 +51,7 @@ class Model:
 
         if DEBUG:
             for cat in self.monitor.keys():
-                print(f"Monitor loaded: {cat} -> {self.monitor[cat].__class__.__name__}")
+                log.info("Monitor loaded: %s -> %s", cat, self.monitor[cat].__class__.__name__)
             input(":")
         self.last_action = None
         self.config = Config()
@@ -70,71 +76,86 @@ class Model:
         self.state = []
         for a in self.reset_acts:
             self.perform_action(a)
+        self.after_reset()
+
+    def after_reset(self):
+        """reset_acts 実行後の後処理（履歴のクリアなど）"""
+        pass
+
+    def simulate(self, actions):
+        """現在の状態からアクション列を実行できるかシミュレーションする（実機・状態は変更しない）
+        @retval: 最初に実行できないアクションの index。全て実行可能なら None
+        """
+        _, failed = self.sm.simulate(actions)
+        for i, action in enumerate(actions[:failed]):
+            if action not in self.acts:
+                return i
+        return failed
 
     def perform_action(self, action, simulate=False):
         if simulate:
-            sm = self.sm.copy()
-        else:
-            sm = self.sm
+            return self.simulate([action]) is None
+        if not self.accept_action(action):
+            return False
+        self.actor.perform_action(action)
+        return True
+
+    def accept_action(self, action):
+        """状態機械上で action を実行して履歴に記録する（実機の操作は呼び出し側で行う）"""
+        sm = self.sm
         self.last_action = action
         if action in self.acts:
             if sm.trigger(action):
-                if not simulate:
-                    self.actor.perform_action(action)
                 self.state.append(f"act:{action}")
                 self.total_act_count += 1
                 return True
             else:
-                print(f"{action} is not allowed!!")
+                log.debug("%s is not allowed!!", action)
                 return False
         else:
-            print(f"{action} is not found!!")
+            log.debug("%s is not found!!", action)
             return False
 
     def wait(self, duration):
-        time.sleep(duration)
+        self.clock.sleep(duration)
+        return self.record_wait(duration)
+
+    def record_wait(self, duration):
+        """待機を履歴に記録する"""
         self.state.append(f"wait:{duration}")
         return True
 
-    def wait_state_transition(self, category, expect, timeout=0):
-        """状態遷移が起こるまで待つ（timeout 秒で打ち切り）
+    def history_mark(self):
+        """現在の履歴の位置（rewind_history に渡す）"""
+        return len(self.state)
+
+    def rewind_history(self, mark):
+        """履歴を history_mark の位置まで戻す（実機・状態機械はそのまま）"""
+        del self.state[mark:]
+
+    def wait_state_transition(self, category, expect, timeout=0, stop=None):
+        """モニタの状態が期待値になるまで待つ（timeout 秒で打ち切り）
+        push に対応したモニタは状態が変わった時点で起こされる。それ以外はポーリングで待つ
         @param category: 監視する状態のカテゴリ
-        @param expect: 監視する状態の期待値
+        @param expect: 監視する状態の期待値（正規表現）
         @param timeout: タイムアウト時間（秒）
-        @retval: True -> 状態遷移が起こった, False -> タイムアウト
+        @param stop: threading.Event。立てられたら待つのをやめる（タイムアウトとは記録しない）
+        @retval: True -> 期待値になった, False -> タイムアウト（または stop）
         """
-        start_time = time.time()
-        initial_state = copy.deepcopy(self.sm.get_expected_state())
-        while True:
-            current_state = self.actor.get_current_state()
-            monitor_state = self.monitor[category].get_state()
-            # print(f"current_state={current_state} monitor_state={monitor_state}")
-            if current_state != initial_state:
-                if category in monitor_state:
-                    if re.match(expect, str(monitor_state[category])):
-                        return True
-            if timeout > 0 and (time.time() - start_time > timeout):
-                print("wait_state_transition timeout")
-                return False
-            if timeout == 0:
-                return False
-            time.sleep(0.1)
-
-    def wait_state_transition(self, timeout=10):
-        """状態遷移が起こるまで待つ（timeout 秒で打ち切り）"""
-        start_time = time.time()
-        initial_state = copy.deepcopy(self.sm.get_expected_state())
-        while True:
-            current_state = self.actor.get_current_state()
-            if current_state != initial_state:
-                return True
-            if time.time() - start_time > timeout:
-                print("wait_state_transition timeout")
-                return False
-            time.sleep(0.1)
+        if expect is None:
+            return True
+        if self.monitor[category].wait_for(category, expect, timeout, self.clock, stop):
+            return True
+        if stop is not None and stop.is_set():
+            return False
+        log.warning("wait_state_transition timeout: %s -> %s", category, expect)
+        return False
 
-    def check_bug_triggered(self, categories=[]):
+    def check_bug_triggered(self, categories=None, stop_on_ng=False):
         """バグが発生しているかチェック
+        カテゴリごとのモニタは独立なので並列に待つ（全体の待ち時間は最大の timeout）
+        @param categories: チェックするカテゴリ（省略時はモニタのある全カテゴリ）
+        @param stop_on_ng: True なら ng が出た時点で返す（未確定のカテゴリは ok のまま）
         @retval:
         {
             audio: "ok"/"ng",
@@ -142,33 +163,79 @@ class Model:
             ...
         }
         """
+        if categories is None:
+            categories = list(self.monitor.keys())
+        expected = self.sm.get_expected_state()
+        waits = {}
         for cat in categories:
-            if cat in self.monitor:
-                expect = self.sm.get_expected_state().get(cat, None)
-                timeout = self.config.get_monitor_timeout(cat)
-                self.wait_state_transition(cat, expect, timeout)
-                self.bug_state[cat] = self.monitor[cat].check_bug_triggered()
-            else:
-                self.bug_state[cat] = "ok"
+            self.bug_state[cat] = "ok"
+            expect = expected.get(cat)
+            # モニタが無い、または状態機械に無いカテゴリ（"dummy" など）は待つものがない
+            if cat in self.monitor and expect is not None:
+                waits[cat] = (expect, self.config.get_monitor_timeout(cat))
+        if not waits:
+            return self.bug_state
+
+        if isinstance(self.clock, VirtualClock):
+            return self._check_bug_virtual(waits, stop_on_ng)
+
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=len(waits))
+        futures = {executor.submit(self.wait_state_transition, cat, expect, timeout, stop): cat
+                   for cat, (expect, timeout) in waits.items()}
+        try:
+            for future in as_completed(futures):
+                if not future.result():
+                    self.bug_state[futures[future]] = "ng"
+                    if stop_on_ng:
+                        break
+        finally:
+            # 早期終了した場合は残りの待ちを止めてから返す（裏で timeout まで走らせない）
+            stop.set()
+            for cat in waits:
+                self.monitor[cat].interrupt()
+            executor.shutdown(wait=True, cancel_futures=True)
+        return self.bug_state
+
+    def _check_bug_virtual(self, waits, stop_on_ng):
+        """VirtualClock の時刻はワーカースレッドから進めず、このスレッドで全カテゴリを順に
+        ポーリングして POLL_INTERVAL ずつ進める（並列に待つのと同じく全体の待ち時間は最大の timeout）"""
+        start = self.clock.now()
+        pending = {cat: (expect, start + timeout) for cat, (expect, timeout) in waits.items()}
+        while pending:
+            for cat, (expect, deadline) in list(pending.items()):
+                if self.monitor[cat].matches(cat, expect):
+                    del pending[cat]
+                elif self.clock.now() >= deadline:
+                    log.warning("wait_state_transition timeout: %s -> %s", cat, expect)
+                    self.bug_state[cat] = "ng"
+                    del pending[cat]
+                    if stop_on_ng:
+                        return self.bug_state
+            if pending:
+                self.clock.sleep(POLL_INTERVAL)
         return self.bug_state
 
 class TestModel(Model):
     def __init__(self):
-        super().__init__()
+        # 実機がないので仮想時計で動かす（待機・自動遷移は即座に進む）
+        super().__init__(clock=VirtualClock())
         self.actor = DummyActor()
         self.acts = self.actor.get_action()
         self.monitor = None
-        self.sm = StateMachine()
+        self.sm = StateMachine(clock=self.clock)
         self.reset_acts = []
         self.total_bug_count = 0
         self.total_act_count = 0
         self.checked = False
         self.bugs = []
+        self.bug_index = BugPathIndex([])
+        self.hist = []
         self.reset()
 
-    def reset(self):
-        super().reset()
+    def after_reset(self):
         self.hist = []
+        self.bug_index.clear()
         self.checked = False
         for k in self.bug_state.keys():
             self.bug_state[k] = "ok"
@@ -191,34 +258,53 @@ class TestModel(Model):
         ]
         """
         self.bugs = bugs
+        # 履歴を1手ずつ照合できるよう path をまとめてオートマトンにする
+        self.bug_index = BugPathIndex([bug["path"] for bug in bugs])
+        for token in self.hist:
+            self.bug_index.push(token)
 
-    def perform_action(self, action, simulate=False):
-        ret = super().perform_action(action, simulate)
+    def push_hist(self, token):
+        self.hist.append(token)
+        self.bug_index.push(token)
+
+    def accept_action(self, action):
+        ret = super().accept_action(action)
         if ret:
-            self.hist.append(action)
+            self.push_hist(action)
         return ret
 
-    def wait(self, duration):
-        # super().wait(duration) は実際にはsleepするので省略
-        self.hist.append(f"wait:{duration}")
+    def record_wait(self, duration):
+        self.push_hist(f"wait:{duration}")
         return True
 
-    def check_bug_triggered(self):
-        """バグ発生したか確認"""
+    def history_mark(self):
+        return len(self.hist)
+
+    def rewind_history(self, mark):
+        while len(self.hist) > mark:
+            self.hist.pop()
+            self.bug_index.pop()
+        self.checked = False
+
+    def check_bug_triggered(self, categories=None, stop_on_ng=False):
+        """バグ発生したか確認（履歴から判定するので引数は使わない）
+        履歴に現れた path ごとに、出現1回につき1回 prob の確率でバグが出る（定義順に判定）"""
         for k in self.bug_state.keys():
             self.bug_state[k] = "ok"
-        for bug in self.bugs:
-            plen = len(bug["path"])
-            for i in range(len(self.hist) - plen + 1):
-                if self.hist[i:i + plen] == bug["path"]:
-                    if bug["prob"] > random.uniform(0, 1.0):
-                        for k in bug["bug"]:
-                            self.bug_state[k] = "ng"
-                        if not self.checked:
-                            self.checked = True
-                            self.total_bug_count += 1
-                            print(f"Bug!! path={bug['path']} "
-                                  f"total_act={self.total_act_count} "
-                                  f"bug_count={self.total_bug_count}")
-                        return self.bug_state
+        for pid, count in self.bug_index.matches():
+            bug = self.bugs[pid]
+            for _ in range(count):
+                if bug["prob"] > random.uniform(0, 1.0):
+                    for k in bug["bug"]:
+                        self.bug_state[k] = "ng"
+                    if not self.checked:
+                        self.checked = True
+                        self.total_bug_count += 1
+                        log.info("Bug!! path=%s total_act=%d bug_count=%d",
+                                 bug["path"], self.total_act_count, self.total_bug_count,
+                                 extra={"fields": {"event": "bug", "path": bug["path"],
+                                                   "bug": bug["bug"],
+                                                   "total_act": self.total_act_count,
+                                                   "bug_count": self.total_bug_count}})
+                    return self.bug_state
         return self.bug_state
@@ -0,0 +1,181 @@
+import re
+import asyncio
+import inspect
+import sys
+from pathlib import Path
+
+# 上位ディレクトリをパスに追加
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.Clock import VirtualClock
+from src.Monitor.Monitor import POLL_INTERVAL
+from src.Log import get_logger
+
+log = get_logger("ModelAsync")
+
+
+async def _call(func, blocking, *args):
+    """func がコルーチン関数なら await、そうでなければ blocking のときだけ別スレッドで実行する"""
+    if inspect.iscoroutinefunction(func):
+        return await func(*args)
+    if blocking:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+
+class AsyncActor:
+    """Actor の非同期版
+    actor.perform_action が async def ならそのまま await する。
+    通常の関数で blocking=True なら（実機の通信などで止まる前提で）スレッドに逃がす
+    """
+    def __init__(self, actor, blocking=True):
+        self.actor = actor
+        self.blocking = blocking
+
+    def get_action(self):
+        return self.actor.get_action()
+
+    async def perform_action(self, action):
+        return await _call(self.actor.perform_action, self.blocking, action)
+
+
+class AsyncMonitor:
+    """Monitor の非同期版（get_state を await できるようにする）"""
+    def __init__(self, monitor, blocking=True):
+        self.monitor = monitor
+        self.blocking = blocking
+        self.category = monitor.category
+
+    async def get_state(self, category):
+        return await _call(self.monitor.get_state, self.blocking, category)
+
+
+class AsyncModel:
+    """Model の非同期版
+    状態機械・履歴の更新は元の model をそのまま使い、実機の操作・待機・モニタだけを await にする。
+    1つのイベントループで複数の AsyncModel（複数ベンチ）を同時に動かせる。
+
+    @param model: Model / TestModel
+    @param real_time: False なら待機は model.clock で進める（省略時は VirtualClock のときだけ False）
+    @param blocking: Actor / Monitor の同期関数をスレッドで実行するか
+    """
+    def __init__(self, model, real_time=None, blocking=True):
+        self.model = model
+        if real_time is None:
+            real_time = not isinstance(model.clock, VirtualClock)
+        self.real_time = real_time
+        self.actor = AsyncActor(model.actor, blocking)
+        self.monitor = {}
+        if model.monitor:
+            self.monitor = {cat: AsyncMonitor(m, blocking) for cat, m in model.monitor.items()}
+
+    def __getattr__(self, name):
+        # reset_acts / get_current_state / sm などは元の model に任せる
+        if name == "model":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    async def sleep(self, duration):
+        if not self.real_time:
+            # 仮想時計はその場で時刻が進む（自動遷移もここで発火する）
+            self.model.clock.sleep(duration)
+        elif duration > 0:
+            await asyncio.sleep(duration)
+
+    async def reset(self):
+        self.model.state = []
+        for a in self.model.reset_acts:
+            await self.perform_action(a)
+        self.model.after_reset()
+
+    async def simulate(self, actions):
+        return self.model.simulate(actions)
+
+    async def perform_action(self, action, simulate=False):
+        if simulate:
+            return self.model.simulate([action]) is None
+        if not self.model.accept_action(action):
+            return False
+        await self.actor.perform_action(action)
+        return True
+
+    async def wait(self, duration):
+        await self.sleep(duration)
+        return self.model.record_wait(duration)
+
+    async def get_state(self, category):
+        if category in self.monitor:
+            return await self.monitor[category].get_state(category)
+        return "unknown"
+
+    async def wait_state_transition(self, category, expect, timeout=0):
+        """モニタの値が expect（正規表現）に一致するまで待つ（timeout 秒で打ち切り）
+        push に対応したモニタは notify で起こされるまで await し、それ以外はポーリングする
+        @retval: True -> 一致した, False -> タイムアウト
+        """
+        if expect is None:
+            return True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        monitor = self.monitor[category].monitor
+        changed = asyncio.Event()
+        unsubscribe = None
+        if monitor.supports_push:
+            # notify は別スレッドから呼ばれることがあるのでループ経由で起こす
+            unsubscribe = monitor.subscribe(
+                category, lambda cat, value: loop.call_soon_threadsafe(changed.set))
+        try:
+            while True:
+                changed.clear()
+                value = await self.get_state(category)
+                if re.match(expect, str(value)):
+                    return True
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    log.warning("wait_state_transition timeout: %s -> %s", category, expect)
+                    return False
+                if unsubscribe is None:
+                    await asyncio.sleep(min(POLL_INTERVAL, remaining))
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if unsubscribe is not None:
+                unsubscribe()
+
+    async def check_bug_triggered(self, categories=None, stop_on_ng=False):
+        """バグが発生しているかチェック（Model.check_bug_triggered と同じく全カテゴリを並列に待つ）
+        @param categories: チェックするカテゴリ（省略時はモニタのある全カテゴリ）
+        @param stop_on_ng: True なら ng が出た時点で残りの待ちを取り消して返す
+        @retval: {audio: "ok"/"ng", ...}
+        """
+        model = self.model
+        if not self.monitor:
+            # TestModel は履歴から判定するので待つものがない
+            return model.check_bug_triggered(categories, stop_on_ng)
+        if categories is None:
+            categories = list(self.monitor.keys())
+        expected = model.sm.get_expected_state()
+        tasks = {}
+        for cat in categories:
+            model.bug_state[cat] = "ok"
+            if cat in self.monitor:
+                timeout = model.config.get_monitor_timeout(cat)
+                task = asyncio.ensure_future(
+                    self.wait_state_transition(cat, expected.get(cat, None), timeout))
+                tasks[task] = cat
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.result():
+                        model.bug_state[tasks[task]] = "ng"
+                if stop_on_ng and any(model.bug_state[tasks[t]] == "ng" for t in done):
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        return model.bug_state
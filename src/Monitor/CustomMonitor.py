@@ -1,6 +1,8 @@
 from .Monitor import Monitor
 
 class CustomMonitor(Monitor):
+    supports_push = True
+
     def __init__(self, category="custom"):
         super().__init__()
         self.category = category
@@ -12,4 +14,5 @@ class CustomMonitor(Monitor):
 
     def set_state(self, category, value):
         self.current_state = value
+        self.notify(category, value)
 
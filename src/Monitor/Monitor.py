@@ -1,15 +1,25 @@
 from pathlib import Path
 import sys, random
+import re
+import threading
 
 # 上位ディレクトリをパスに追加
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
 from src.StateMachine import StateMachine
+from src.Clock import Clock
+
+POLL_INTERVAL = 0.1  # push できないモニタのポーリング間隔（秒）
 
 class Monitor:
+    # set_state などで notify を呼ぶモニタは True にする（False ならポーリングで待つ）
+    supports_push = False
+
     def __init__(self):
         self.category = ""
         self._check_state = {}
+        self._subscribers = {}
+        self._cond = threading.Condition()
 
     def register_check_state(self, category, func):
         """State確認用関数を登録する"""
@@ -20,11 +30,76 @@ class Monitor:
         現在の状態を返す
         """
         if category in self._check_state:
-            return self._check_state[category]()
+            return self._check_state[category](category)
         else:
             return "unknown"
 
+    def subscribe(self, category, callback):
+        """状態が変わったときに callback(category, value) を呼ぶ
+        @retval: 購読を解除する関数
+        """
+        with self._cond:
+            self._subscribers.setdefault(category, []).append(callback)
+
+        def unsubscribe():
+            with self._cond:
+                callbacks = self._subscribers.get(category, [])
+                if callback in callbacks:
+                    callbacks.remove(callback)
+        return unsubscribe
+
+    def notify(self, category, value):
+        """状態の変化を待っているスレッド・購読者に知らせる（状態を更新した後に呼ぶ）"""
+        with self._cond:
+            callbacks = list(self._subscribers.get(category, []))
+            self._cond.notify_all()
+        for callback in callbacks:
+            callback(category, value)
+
+    def interrupt(self):
+        """wait_for で眠っているスレッドを起こす（stop を立てた後に呼ぶ）"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def matches(self, category, expect):
+        """category の現在の状態が expect（正規表現）に一致するか"""
+        return re.match(expect, str(self.get_state(category))) is not None
+
+    def wait_for(self, category, expect, timeout=0, clock=None, stop=None):
+        """category の状態が expect（正規表現）に一致するまで待つ（timeout 秒で打ち切り）
+        supports_push なら notify で起こされるまで眠り、そうでなければ clock でポーリングする
+        （実時間でない clock では notify を待っても時刻が進まないので、push でもポーリングする）
+        @param stop: threading.Event。立てられたら一致を待たずに False を返す
+                     （push で眠っているスレッドは interrupt で起こす）
+        @retval: True -> 一致した, False -> タイムアウト（または stop）
+        """
+        def stopped():
+            return stop is not None and stop.is_set()
+
+        clock = clock or Clock()
+        deadline = clock.now() + timeout
+        if self.supports_push and clock.realtime:
+            with self._cond:
+                while True:
+                    if stopped():
+                        return False
+                    if self.matches(category, expect):
+                        return True
+                    remaining = deadline - clock.now()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+
+        while True:
+            if self.matches(category, expect):
+                return True
+            if stopped() or clock.now() >= deadline:
+                return False
+            clock.sleep(POLL_INTERVAL)
+
 class DummyMonitor(Monitor):
+    supports_push = True
+
     def __init__(self,
                  category=["power", "audio"]):
         """
@@ -43,3 +118,4 @@ class DummyMonitor(Monitor):
 
     def set_state(self, category, value):
         self.current_state[category] = value
+        self.notify(category, value)
@@ -0,0 +1,203 @@
+from pathlib import Path
+import sys
+import threading
+
+# パス設定
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.Log import get_logger
+
+log = get_logger("Planner")
+
+
+class ExecutionPlanner:
+    """リセットの代わりに直前の経路と共通の接頭辞を使い回して経路を実行する
+
+    ベンチ（Model）ごとに、最後のリセット以降に実行したステップと各ステップ後の状態・履歴位置を
+    trail として覚えておく。次の経路が trail と接頭辞を共有していれば、その接頭辞の直後の状態まで
+    ExplorerStateBase.Explorer.find_shortest_path の最短経路で移動し、残りのステップだけを実行する。
+    移動の操作数が「リセット + 接頭辞の再実行」より多い場合や移動できない場合はリセットする。
+    移動後は model.rewind_history で履歴を接頭辞の直後まで戻し、バグチェックがリセットした場合と
+    同じ履歴を見るようにする（実機が移動中に通った状態は履歴に残らない）。
+
+    engine の planner に渡すと run_iteration がリセットの代わりに begin を呼ぶ。
+    AsyncSearchEngine は begin の判断（route）と確認（arrive）だけを使い、操作を await する。
+    経路は常に最初のリセット直後の状態（home）から作る。Model.reset は reset_acts を実行するだけで
+    状態機械を初期状態に戻すとは限らないので、リセット後に home と違えば最短経路で home に戻し、
+    それでも戻れなければ begin は None を返す（その経路は実行しない）。
+    """
+    def __init__(self, graph, reset_acts=None):
+        """
+        @param graph: ExplorerStateBase.Explorer（未構築なら prepare で build_graph する）
+        @param reset_acts: Model.reset で実行するアクション（省略時は prepare の model から取る）
+        """
+        self.graph = graph
+        self.reset_acts = reset_acts
+        self.lock = threading.RLock()  # graph を共有するエンジンがあればそのロックに差し替える
+        self.home_state = None
+        self.trails = {}  # id(model) -> [(ステップ, ステップ後の状態, 履歴位置)]。先頭は home
+        self.stats = {"reset": 0, "navigate": 0, "reused_steps": 0, "navigate_acts": 0}
+
+    def prepare(self, model):
+        """探索開始前の初期化（グラフが未構築なら構築する）"""
+        if self.reset_acts is None:
+            self.reset_acts = list(model.reset_acts)
+        if getattr(self.graph, "table", None) is None:
+            self.graph.build_graph(reset_acts=self.reset_acts)
+        self.home_state = None
+        self.trails = {}
+        for k in self.stats:
+            self.stats[k] = 0
+
+    def home(self, model):
+        """経路の開始状態（リセット直後の状態）。model が未リセットならここでリセットする"""
+        if id(model) not in self.trails:
+            self.reset(model)
+        return self.home_state
+
+    def is_home_known(self, model):
+        """model をこの planner でリセットしたことがあるか（無ければ home がリセットする）"""
+        return id(model) in self.trails
+
+    def reset(self, model):
+        """model をリセットして home に戻す
+        @retval: home に着いたか
+        """
+        model.reset()
+        route = self.route_home(model)
+        if route:
+            mark = model.history_mark()
+            for action in route:
+                if not model.perform_action(action):
+                    break
+            # 移動に使った操作はバグチェックの履歴に残さない
+            model.rewind_history(mark)
+        return self.mark_home(model)
+
+    def route_home(self, model):
+        """リセット直後の model を home に戻す操作名のリスト
+        （home にいれば []、戻れなければ None。実行したら履歴を戻してから mark_home を呼ぶ）"""
+        state = model.get_current_state()
+        if self.home_state is None or state == self.home_state:
+            return []
+        try:
+            with self.lock:
+                route = self.graph.find_shortest_path(state, self.home_state)
+        except KeyError:
+            # 状態空間に無い値（遷移表で表せない状態）
+            return None
+        return None if route is None else [edge.action for edge in route]
+
+    def mark_home(self, model):
+        """model.reset（と route_home の移動）の直後に呼ぶ（trail をリセット直後の状態から始め直す）
+        @retval: home にいるか。いなければ trail を作らない（次の begin / home でリセットし直す）
+        """
+        state = dict(model.get_current_state())
+        if self.home_state is None:
+            self.home_state = state
+        self.stats["reset"] += 1
+        if state != self.home_state:
+            log.warning("not at the start state after reset: %s", state)
+            self.trails.pop(id(model), None)
+            return False
+        self.trails[id(model)] = [(None, state, model.history_mark())]
+        return True
+
+    @staticmethod
+    def step_key(step):
+        """order の並べ替えキー（hash と違ってオブジェクトのアドレスによらず、実行ごとに同じ）"""
+        idx = getattr(step, "idx", None)
+        if idx is not None:
+            # ExplorerNode（同じ接頭辞は同じノードを通る）
+            return int(idx)
+        # GraphEdge
+        return (step.action, str(step.dst))
+
+    def order(self, paths):
+        """共通の接頭辞を持つ経路が隣り合うように並べ替える（接頭辞木の深さ優先順）"""
+        paths.sort(key=lambda path: tuple(self.step_key(step) for step in path))
+        return paths
+
+    def shared_prefix(self, model, path):
+        """path と model の trail が共有するステップ数"""
+        trail = self.trails.get(id(model), [])
+        n = 0
+        for (step, _, _), node in zip(trail[1:], path):
+            if step != node:
+                break
+            n += 1
+        return n
+
+    def pick(self, model, paths):
+        """paths のうち model の trail と最も長い接頭辞を共有する経路の index"""
+        best, best_n = 0, -1
+        for i, path in enumerate(paths):
+            n = self.shared_prefix(model, path)
+            if n > best_n:
+                best, best_n = i, n
+        return best
+
+    def begin(self, model, steps):
+        """steps（engine.steps(path) のリスト）の実行準備をする
+        @retval: 実行済みとして飛ばせる先頭のステップ数。home に戻れなかったら None
+        """
+        n, route = self.route(model, steps)
+        if route is not None:
+            for edge in route:
+                if not model.perform_action(edge.action):
+                    break
+            n = self.arrive(model, n, route)
+            if n is not None:
+                return n
+        if not self.reset(model):
+            return None
+        return 0
+
+    def route(self, model, steps):
+        """begin の判断部分。共有する接頭辞のステップ数と、その直後の状態へ移動する経路を返す
+        @retval: (n, route)。route が None ならリセットする。
+                 そうでなければ route の操作を実行してから arrive を呼ぶ
+        """
+        path = [node for _, _, node in steps]
+        trail = self.trails.get(id(model))
+        if trail is None:
+            return 0, None
+        # 同じ経路の再実行でも最後のステップは実行し直す
+        n = min(self.shared_prefix(model, path), len(path) - 1)
+        if n == len(trail) - 1:
+            # 接頭辞の直後にいる（リセット直後を含む）
+            model.rewind_history(trail[n][2])
+            self.stats["reused_steps"] += n
+            return n, []
+
+        _, target, _ = trail[n]
+        with self.lock:
+            route = self.graph.find_shortest_path(model.get_current_state(), target)
+        redo = sum(1 for kind, _, _ in steps[:n] if kind == "act")
+        if route is None or len(route) >= len(self.reset_acts) + redo:
+            return 0, None
+        return n, route
+
+    def arrive(self, model, n, route):
+        """route の操作を実行した後に呼ぶ
+        @retval: 飛ばせるステップ数。接頭辞の直後の状態に着いていなければ None（リセットする）
+        """
+        trail = self.trails[id(model)]
+        if n == len(trail) - 1:
+            # route で履歴を戻し済み（移動なし）
+            return n
+        _, target, mark = trail[n]
+        if model.get_current_state() != target:
+            # 自動遷移などで想定の状態にならなかった
+            return None
+        model.rewind_history(mark)
+        del trail[n + 1:]
+        self.stats["navigate"] += 1
+        self.stats["navigate_acts"] += len(route)
+        self.stats["reused_steps"] += n
+        return n
+
+    def record(self, model, node):
+        """node のステップを実行した直後に呼ぶ"""
+        self.trails[id(model)].append(
+            (node, dict(model.get_current_state()), model.history_mark()))
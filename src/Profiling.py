@@ -0,0 +1,146 @@
+from pathlib import Path
+import sys
+import time
+import functools
+import importlib
+import contextlib
+import cProfile
+import pstats
+import io
+
+# パス設定
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+# 計測対象（モジュール, クラス名 or None, 関数名）。register で追加できる
+# 探索中に実際に呼ばれるもの（条件判定・遷移は CompiledAction、経路の一括検証は TransitionTable）
+TARGETS = [
+    ("src.Config", "CompiledAction", "is_allowed"),
+    ("src.Config", "CompiledAction", "next_state"),
+    ("src.StateMachine", None, "simulate_actions"),
+    ("src.StateMachine", "StateMachine", "trigger"),
+    ("src.StateSpace", "StateSpace", "transition"),
+    ("src.StateSpace", "TransitionTable", "expand"),
+    ("src.StateSpace", "TransitionTable", "check_paths"),
+    ("src.ExplorerStateBase", "Explorer", "build_graph"),
+]
+
+_counters = {}  # 名前 -> [呼び出し回数, 累積秒数]
+_patched = {}   # 名前 -> [(差し替えたオブジェクト, 属性名, 元の関数), ...]
+
+
+def _name(module, owner, attr):
+    return f"{owner}.{attr}" if owner else f"{module.rsplit('.', 1)[-1]}.{attr}"
+
+
+def register(module, owner, attr):
+    """計測対象を追加する（enable 中なら次の enable から有効）"""
+    target = (module, owner, attr)
+    if target not in TARGETS:
+        TARGETS.append(target)
+
+
+def _wrap(name, func):
+    counter = _counters.setdefault(name, [0, 0.0])
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            counter[0] += 1
+            counter[1] += time.perf_counter() - start
+    return wrapper
+
+
+def enable():
+    """計測対象の関数をカウンタ・タイマー付きのものに差し替える
+    無効時は元の関数のままなので計測のコストはかからない。
+    モジュールの関数は from ... import で取り込んだ先のモジュールの名前も差し替えるが、
+    enable より後に import したモジュールや、関数を変数・引数に持っている場合は計測されない。
+    回数・時間はスレッド間で排他しないので、並列実行中はおおよその値になる
+    """
+    for module, owner, attr in TARGETS:
+        name = _name(module, owner, attr)
+        if name in _patched:
+            continue
+        obj = importlib.import_module(module)
+        if owner:
+            obj = getattr(obj, owner)
+        func = obj.__dict__[attr]
+        wrapper = _wrap(name, func)
+        holders = [(obj, attr)]
+        if not owner:
+            holders += [(m, k) for m in list(sys.modules.values()) if m is not obj
+                        for k, v in list(getattr(m, "__dict__", {}).items()) if v is func]
+        _patched[name] = [(holder, key, func) for holder, key in holders]
+        for holder, key in holders:
+            setattr(holder, key, wrapper)
+
+
+def disable():
+    """enable で差し替えた関数を元に戻す（カウンタはそのまま）"""
+    for patches in _patched.values():
+        for obj, attr, func in patches:
+            setattr(obj, attr, func)
+    _patched.clear()
+
+
+def is_enabled():
+    return bool(_patched)
+
+
+def reset():
+    _counters.clear()
+
+
+def stats():
+    """{名前: {"calls": 回数, "total_s": 累積秒数, "mean_us": 1回あたりのマイクロ秒}}"""
+    return {
+        name: {"calls": calls, "total_s": total,
+               "mean_us": 1e6 * total / calls if calls else 0.0}
+        for name, (calls, total) in _counters.items()
+    }
+
+
+def report(file=None):
+    """stats() を累積時間の長い順に表で出力する"""
+    file = file or sys.stdout
+    rows = sorted(stats().items(), key=lambda kv: kv[1]["total_s"], reverse=True)
+    print(f"{'function':40} {'calls':>10} {'total[s]':>10} {'mean[us]':>10}", file=file)
+    for name, s in rows:
+        print(f"{name:40} {s['calls']:>10} {s['total_s']:>10.4f} {s['mean_us']:>10.2f}", file=file)
+
+
+@contextlib.contextmanager
+def counting(clear=True):
+    """with の間だけ計測対象のカウンタ・タイマーを有効にする"""
+    if clear:
+        reset()
+    was_enabled = is_enabled()
+    enable()
+    try:
+        yield _counters
+    finally:
+        if not was_enabled:
+            disable()
+
+
+@contextlib.contextmanager
+def profile(path=None, sort="cumulative", limit=30, file=None):
+    """with の間を cProfile で計測する
+    @param path: 指定すると pstats 形式で書き出す（snakeviz などで読める）
+    @param sort / limit: path を省略した場合に出力する統計の並び順と行数
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path is not None:
+            profiler.dump_stats(path)
+        else:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(limit)
+            print(out.getvalue(), file=file or sys.stdout)
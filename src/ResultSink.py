@@ -0,0 +1,120 @@
+from pathlib import Path
+import sys
+import os
+import json
+import time
+import threading
+
+# パス設定
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.Log import get_logger
+
+log = get_logger("ResultSink")
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+class ResultWriter:
+    """探索結果を1イテレーション1行の JSON で追記していく書き出し先
+
+    ファイルは追記モードで開くので、途中で落ちても書き出し済みの行は残り、
+    同じファイルに続けて書けば前回の実行の後ろに追記される。
+    複数ベンチから並列に write されてもよい（行単位で排他する）。
+    """
+    def __init__(self, path, flush_every=1, fsync="interval", fsync_interval=5.0):
+        """
+        @param path: 書き出すファイル
+        @param flush_every: この件数たまったらファイルに書く（1 なら毎イテレーション）
+        @param fsync: "always" -> 書くたびに fsync, "interval" -> fsync_interval 秒に1回, "never" -> OS 任せ
+        @param fsync_interval: fsync="interval" のときの間隔（秒）
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}: {fsync}")
+        self.path = Path(path)
+        self.flush_every = max(1, flush_every)
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.count = 0  # このインスタンスで書いた件数
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def write(self, record):
+        """record（JSON にできる辞書）を1行として追加する"""
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self._buffer.append(line)
+            self.count += 1
+            if len(self._buffer) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        """バッファに残った行をファイルに書き、fsync="never" 以外なら fsync する"""
+        with self._lock:
+            self._flush(sync=self.fsync != "never")
+
+    def _flush(self, sync=None):
+        if self._file is None:
+            return
+        if self._buffer:
+            self._file.write("".join(self._buffer))
+            self._buffer.clear()
+        self._file.flush()
+        if sync is None:
+            sync = (self.fsync == "always" or
+                    (self.fsync == "interval" and
+                     time.monotonic() - self._last_sync >= self.fsync_interval))
+        if sync:
+            os.fsync(self._file.fileno())
+            self._last_sync = time.monotonic()
+
+    def tell(self):
+        """ここまでに write した行をすべて書き出し、ファイルの末尾の位置を返す（read_results の start 用）"""
+        with self._lock:
+            self._flush()
+            return os.path.getsize(self.path)
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._flush(sync=self.fsync != "never")
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_results(path, type="iteration", start=0):
+    """ResultWriter で書いたファイルを1行ずつ読んで辞書を返すイテレータ
+    ファイル全体は読み込まないので大きな結果ファイルでも使える。
+    書き込み途中で落ちた最後の行（JSON として壊れた行）は読み飛ばす
+    @param type: この type のレコードだけ返す（None なら全部）
+    @param start: 読み始めるバイト位置（ResultWriter.tell の値）
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                log.warning("%s: broken record skipped: %.80r", path, line)
+                continue
+            if type is None or record.get("type") == type:
+                yield record
+
+
+def read_bugs(path, start=0):
+    """バグが出たイテレーションのレコードだけを返すイテレータ"""
+    for record in read_results(path, start=start):
+        if record.get("bug"):
+            yield record
@@ -1,85 +1,93 @@
 import yaml
-import threading
 import time
-import re
-import ast
+import math
 import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parent.parent))
-from src.Config import Config
+from src.Clock import Clock
+from src.Log import get_logger
+from src.Config import (Config, CompiledAction, Requirement,
+                        compile_action, compile_condition, compile_required,
+                        convert_str_to_list)
 
-def convert_str_to_list(str_value):
-    """ "[a,b,c]" -> ["a", "b", "c"] """
-    str_value = str_value.strip()
-    if str_value.startswith("[") and str_value.endswith("]"):
-        items = str_value[1:-1].split(",")
-        return [item.strip().strip('"').strip("'") for item in items]
-    else:
-        raise ValueError(f"リスト形式ではありません: {str_value}")
+log = get_logger("StateMachine")
 
 def evaluate_condition(current_value, condition_str):
     """シンプルなDSLを評価する"""
-    if condition_str == "else":
-        return True
-
-    if "not in " in condition_str:
-        _, rhs = condition_str.split("not in ")
-        try:
-            values = ast.literal_eval(rhs.strip())
-        except:
-            values = convert_str_to_list(rhs.strip())
-        return current_value not in values
-    elif "in " in condition_str:
-        _, rhs = condition_str.split("in ")
-        try:
-            values = ast.literal_eval(rhs.strip())
-        except:
-            values = convert_str_to_list(rhs.strip())
-        return current_value in values
-    elif "==" in condition_str:
-        lhs, rhs = condition_str.split("==")
-        return current_value == rhs.strip()
-    elif "!=" in condition_str:
-        lhs, rhs = condition_str.split("!=")
-        return current_value != rhs.strip()
-    else:
-        raise ValueError(f"Unknown condition: {condition_str}")
+    return compile_condition(condition_str)(current_value)
 
 def get_next_state(action_def, current_states):
     """
-    action_def: YAMLを読み込んだ辞書
+    action_def: コンパイル済みのCompiledAction（YAMLの辞書も可）
     current_states: {"Audio": "Pause", "Display": "Stop", "Power": "Off"}
     """
-    next_states = current_states.copy()
-    transitions = action_def.get("transitions", {})
-
-    for category, rules in transitions.items():
-        # Power: On のような書き方に対応
-        if isinstance(rules, str):
-            next_states[category] = rules
+    if not isinstance(action_def, CompiledAction):
+        action_def = compile_action(None, action_def)
+    return action_def.next_state(current_states)
+
+def simulate_actions(compiled_actions, state, actions):
+    """状態のスナップショットにアクション列を適用した結果を返す（YAML読込・タイマー・出力なし）
+    @param compiled_actions: {操作名: CompiledAction}
+    @param state: 開始状態（変更しない）
+    @param actions: 操作名のリスト
+    @retval: (最終状態, 最初に拒否された操作の index。全て実行可能なら None)
+    """
+    for i, action in enumerate(actions):
+        op_def = compiled_actions.get(action)
+        if op_def is None or not op_def.is_allowed(state):
+            return state, i
+        state = op_def.next_state(state)
+    return state, None
+
+def settle_auto_transition(rules, value, duration, elapsed=None):
+    """1カテゴリの値に duration 秒の待機中の自動遷移を適用する
+    タイマーは値が変わったときだけ張り直されるので、待機前にその値に入ってからの
+    経過時間 elapsed が分からなければ、遷移するかどうかが決まらないことがある
+    @param rules: {状態: (秒数, 遷移先)}（StateMachine.auto_transitions の1カテゴリ分）
+    @param elapsed: 待機前にその値に入ってからの経過秒数の範囲 (lo, hi)。None なら不明
+    @retval: (待機後の値, その値に入ってからの経過秒数の範囲)、または None（決まらない）
+    """
+    if value not in rules:
+        return value, None
+    if elapsed is None:
+        # タイマーが未発火なので経過時間は after 未満
+        elapsed = (0.0, math.nextafter(rules[value][0], -math.inf))
+    lo, hi = elapsed[0] + duration, elapsed[1] + duration
+    while value in rules:
+        after, nxt = rules[value]
+        if after <= 0:
+            return None
+        if hi < after:
+            return value, (lo, hi)
+        if lo < after:
+            return None
+        value, lo, hi = nxt, lo - after, hi - after
+    return value, None
+
+def simulate_wait(auto_transitions, state, duration, elapsed=None):
+    """状態のスナップショットに duration 秒の待機中の自動遷移を適用した結果を返す
+    @param auto_transitions: {カテゴリ: {状態: (秒数, 遷移先)}}
+    @param elapsed: {カテゴリ: 経過秒数の範囲}（settle_auto_transition 参照）。無いカテゴリは不明
+    @retval: (待機後の状態, 待機後の elapsed)、またはいずれかのカテゴリの値が決まらなければ None
+    """
+    state = dict(state)
+    elapsed = dict(elapsed or {})
+    for component, rules in auto_transitions.items():
+        if component not in state:
             continue
-
-        matched = False
-        else_rule = None
-        for rule in rules:
-            cond = rule.get("condition")
-            next_value = rule["next"]
-
-            if cond == "else":
-                else_rule = next_value
-                continue
-
-            current_value = current_states.get(category)
-            if evaluate_condition(current_value, cond):
-                next_states[category] = next_value
-                matched = True
-                break
-
-        # どれにも一致しなかった場合 else を適用
-        if not matched and else_rule is not None:
-            next_states[category] = else_rule
-
-    return next_states
+        settled = settle_auto_transition(rules, state[component], duration, elapsed.get(component))
+        if settled is None:
+            return None
+        state[component], elapsed[component] = settled
+    return state, elapsed
+
+def reset_elapsed(before, after, elapsed):
+    """アクションで値が変わったカテゴリの経過時間を 0 に戻した elapsed を返す"""
+    elapsed = dict(elapsed or {})
+    for component, value in after.items():
+        if before.get(component) != value:
+            elapsed[component] = (0.0, 0.0)
+    return elapsed
 
 # 仮の実機状態取得関数（実際はあなたのコードに差し替え）
 def get_actual_state(component):
@@ -104,47 +112,44 @@ class Context:
         for key, value in updates.items():
             self.state[key] = value
 
-    def logger(self, *args):
+    def logger(self, msg, *args):
+        # 引数は出力する時だけ整形する
         if self.log:
-            print(*args)
+            log.info(msg, *args)
 
     def show(self):
-        self.logger("現在の状態:", self.state)
+        if self.log:
+            log.debug("現在の状態: %s", self.state)
 
     def satisfies(self, conditions):
-        def check(key, condition_strs, all_):
-            results = []
-            for condition_str in condition_strs:
-                current = self.get(key)
-                results.append(evaluate_condition(current, condition_str.get("condition")))
-            if all_:
-                return all(results)
-            else:
-                return any(results)
-
-        all_of = conditions.get("all_of", {})
-        any_of = conditions.get("any_of", {})
-
-        if all_of and not all(check(k, v, True) for k, v in all_of.items()):
-            return False
-        if any_of and not any(check(k, v, False) for k, v in any_of.items()):
-            return False
-        return True
+        """conditions: コンパイル済みのRequirement（YAMLの辞書も可）"""
+        if not isinstance(conditions, Requirement):
+            conditions = compile_required(conditions)
+        return conditions.satisfied(self.state)
 
 
 class StateMachine:
-    def __init__(self, log=True):
+    def __init__(self, log=True, clock=None):
         self.log = log
+        # 自動遷移のタイマーはこの時計で動かす（VirtualClock なら実際には待たない）
+        self.clock = clock or Clock()
         self.config = Config()
         self.states = self.config.states
         self.all_states = {name: defn.get("all", []) for name, defn in self.states.items()}
         self.actions = self.config.actions
-        self.init_state = self.ctx = Context({name: defn["initial"] for name, defn in self.states.items()})
+        self.compiled_actions = self.config.compiled_actions
+        self.init_state = self.ctx = Context({name: defn["initial"] for name, defn in self.states.items()},
+                                             log=self.log)
+        # {カテゴリ: {状態: (秒数, 遷移先)}}
+        self.auto_transitions = {
+            name: {state: (rule["after"], rule["to"]) for state, rule in defn["auto_transitions"].items()}
+            for name, defn in self.states.items() if "auto_transitions" in defn
+        }
         self.setup_auto_transitions()
 
-    def logger(self, *args):
+    def logger(self, msg, *args):
         if self.log:
-            print(*args)
+            log.info(msg, *args)
 
     def set_all_states(self, states):
         self.ctx.state = states
@@ -157,30 +162,49 @@ class StateMachine:
         return self.init_state.state
 
     def setup_auto_transitions(self):
-        for component, defn in self.states.items():
-            if "auto_transitions" in defn:
-                for state, rule in defn["auto_transitions"].items():
-                    after = rule["after"]
-                    to_state = rule["to"]
-
-                    def create_auto_fn(comp=component, from_state=state, to_state=to_state):
-                        def auto_transition():
-                            if self.ctx.get(comp) == from_state:
-                                self.logger(f"[AUTO] {comp}: {from_state} -> {to_state}")
-                                self.ctx.set({comp: to_state})
-                                if self.log:
-                                    self.ctx.show()
-                        return auto_transition
-
-                    def schedule_auto_transition():
-                        if self.ctx.get(component) == state:
-                            timer = threading.Timer(after, create_auto_fn())
-                            self.ctx.timers[component] = timer
-                            timer.start()
-
-                    # 最初の初期状態に該当する場合に自動起動
-                    if self.ctx.get(component) == state:
-                        schedule_auto_transition()
+        """各カテゴリの自動遷移タイマーを現在の状態に合わせる
+        状態が変わったカテゴリは古いタイマーを取り消し、新しい状態に自動遷移があれば登録し直す。
+        状態が変わっていなければ既存のタイマーをそのまま使う（経過時間はリセットしない）
+        """
+        timers = self.ctx.timers
+        for component, rules in self.auto_transitions.items():
+            current = self.ctx.get(component)
+            armed = timers.get(component)
+            if armed is not None:
+                from_state, handle = armed
+                if from_state == current:
+                    continue
+                handle.cancel()
+                del timers[component]
+            if current in rules:
+                after, to_state = rules[current]
+                handle = self.clock.call_later(
+                    after, self._create_auto_fn(component, current, to_state))
+                timers[component] = (current, handle)
+
+    def _create_auto_fn(self, comp, from_state, to_state):
+        ctx = self.ctx
+        def auto_transition():
+            if ctx.timers.get(comp, (None, None))[0] == from_state:
+                del ctx.timers[comp]
+            if ctx.get(comp) == from_state:
+                self.logger("[AUTO] %s: %s -> %s", comp, from_state, to_state)
+                ctx.set({comp: to_state})
+                if self.log:
+                    ctx.show()
+        return auto_transition
+
+    def reset_states(self):
+        """全カテゴリを設定の初期状態に戻す（自動遷移のタイマーも初期状態から張り直す）"""
+        self.cancel_auto_transitions()
+        self.ctx.set({name: defn["initial"] for name, defn in self.states.items()})
+        self.setup_auto_transitions()
+
+    def cancel_auto_transitions(self):
+        """登録済みの自動遷移タイマーを全て取り消す"""
+        for _, handle in self.ctx.timers.values():
+            handle.cancel()
+        self.ctx.timers.clear()
 
     def trigger(self, action):
         """_summary_
@@ -191,18 +215,19 @@ class StateMachine:
         Returns:
             bool: success or not
         """
-        if action not in self.actions:
-            self.logger(f"[ERR] 操作 '{action}' は存在しません")
+        op_def = self.compiled_actions.get(action)
+        if op_def is None:
+            self.logger("[ERR] 操作 '%s' は存在しません", action)
             return False
 
-        op_def = self.actions[action]
-        if not self.ctx.satisfies(op_def.get("required", {})):
-            self.logger(f"[REJECT] 操作 '{action}' の条件を満たしません")
+        if not op_def.is_allowed(self.ctx.state):
+            self.logger("[REJECT] 操作 '%s' の条件を満たしません", action)
             return False
 
-        self.logger(f"[OK] 操作 '{action}' 実行")
-        next_state = get_next_state(op_def, self.ctx.state)
-        print(f"Next State: {next_state}")
+        self.logger("[OK] 操作 '%s' 実行", action)
+        next_state = op_def.next_state(self.ctx.state)
+        if self.log:
+            log.debug("Next State: %s", next_state)
         self.ctx.set(next_state)
         self.ctx.show()
         self.setup_auto_transitions()
@@ -226,18 +251,29 @@ class StateMachine:
             expected = self.get_expected_state.get(comp)
             actual = get_actual_state(comp)
             if expected != actual:
-                self.logger(f"[MISMATCH] {comp}: expect={expected} actual={actual}")
+                self.logger("[MISMATCH] %s: expect=%s actual=%s", comp, expected, actual)
                 mismatch = True
             else:
-                self.logger(f"[MATCH] {comp}: state={expected}")
+                self.logger("[MATCH] %s: state=%s", comp, expected)
         return not mismatch
 
+    def simulate(self, actions):
+        """現在の状態からアクション列を実行した場合の (最終状態, 拒否された index)"""
+        return simulate_actions(self.compiled_actions, self.ctx.state, actions)
+
     def copy(self):
+        # __init__ は呼ばない（YAMLの再読込を避ける）
         new_sm = StateMachine.__new__(StateMachine)
-        new_sm.__init__()
+        new_sm.log = self.log
+        new_sm.clock = self.clock
+        new_sm.config = self.config
         new_sm.states = self.states
+        new_sm.all_states = self.all_states
         new_sm.actions = self.actions
-        new_sm.ctx = Context(self.ctx.state)
+        new_sm.compiled_actions = self.compiled_actions
+        new_sm.auto_transitions = self.auto_transitions
+        new_sm.init_state = self.init_state
+        new_sm.ctx = Context(self.ctx.state, log=self.log)
         new_sm.setup_auto_transitions()
         return new_sm
 
@@ -0,0 +1,498 @@
+import json
+import math
+import os
+import numpy as np
+
+from src.StateMachine import settle_auto_transition
+
+CACHE_MAGIC = b"DSGRAPH1"
+CACHE_ALIGN = 64
+NEXT_HOP_LIMIT = 2048  # 全点対の次ホップ表を作る状態数の上限（int16 で n*n*2 byte）
+STATE_ID_MAX = int(np.iinfo(np.int64).max)  # state_id は int64 に収める
+
+
+class StateSpace:
+    """状態空間の整数エンコーディング
+
+    各カテゴリの値を all リスト内のインデックス（小さな整数）に、
+    状態全体をその混合基数表現（1つの整数 = state_id）に変換する。
+    アクションの required / transitions はカテゴリ値ごとの
+    マスク・写像配列に変換しておき、遷移計算を NumPy でまとめて行う。
+    auto_transitions（StateMachine.auto_transitions）を渡すと待機後の状態も求められる。
+    """
+    def __init__(self, all_states, compiled_actions, actions, auto_transitions=None):
+        size = self.size_of(all_states)
+        if size > STATE_ID_MAX:
+            raise ValueError(f"状態空間が大きすぎて state_id を int64 で表せません: "
+                             f"{len(all_states)} カテゴリ, 全状態数 {size}")
+        self.categories = list(all_states.keys())
+        self.values = [list(all_states[k]) for k in self.categories]
+        self.value_index = [{v: i for i, v in enumerate(vals)} for vals in self.values]
+        self.category_index = {k: i for i, k in enumerate(self.categories)}
+
+        # 最後のカテゴリが最下位桁
+        self.radix = np.array([len(v) for v in self.values], dtype=np.int64)
+        self.stride = np.ones(len(self.categories), dtype=np.int64)
+        for i in range(len(self.categories) - 2, -1, -1):
+            self.stride[i] = self.stride[i + 1] * self.radix[i + 1]
+        self.size = size
+
+        self.actions = list(actions)
+        self.action_index = {a: i for i, a in enumerate(self.actions)}
+        self._rules = [self._compile_action(compiled_actions.get(a)) for a in self.actions]
+        # [(カテゴリindex, {状態: (秒数, 遷移先)}), ...]
+        self._auto = [(self.category_index[k], rules)
+                      for k, rules in (auto_transitions or {}).items() if k in self.category_index]
+
+    @staticmethod
+    def size_of(all_states):
+        """全状態数（各カテゴリの値の数の積）。int64 の桁あふれを避けて Python の int で計算する"""
+        return math.prod(len(v) for v in all_states.values())
+
+    @classmethod
+    def fits(cls, all_states):
+        """all_states の state_id が int64 に収まるか"""
+        return cls.size_of(all_states) <= STATE_ID_MAX
+
+    # ---- エンコード / デコード ----
+    def encode(self, state):
+        """状態の辞書 -> state_id"""
+        sid = 0
+        for i, k in enumerate(self.categories):
+            sid += self.value_index[i][state[k]] * int(self.stride[i])
+        return sid
+
+    def decode(self, sid):
+        """state_id -> 状態の辞書"""
+        return {k: self.values[i][(sid // int(self.stride[i])) % int(self.radix[i])]
+                for i, k in enumerate(self.categories)}
+
+    def name(self, sid):
+        """StateMachine.convert_state_to_str と同じ形式の状態名"""
+        return ",".join(f"{k}={v}" for k, v in sorted(self.decode(sid).items()))
+
+    def encode_name(self, name):
+        """状態名 -> state_id（状態空間に無ければ KeyError）"""
+        state = dict(item.split("=", 1) for item in name.split(",")) if name else {}
+        if set(state) != set(self.categories):
+            raise KeyError(name)
+        return self.encode(state)
+
+    def digits(self, ids):
+        """state_id の配列 -> (len(ids), カテゴリ数) の値インデックス配列"""
+        ids = np.asarray(ids, dtype=np.int64)
+        return (ids[:, None] // self.stride) % self.radix
+
+    # ---- 遷移 ----
+    def _compile_action(self, action):
+        """CompiledAction をマスク・写像配列に変換する。
+
+        Returns:
+            None（常に実行不可）または (all_of, any_of, transitions)
+            all_of / any_of: [(カテゴリindex, boolマスク), ...]
+            transitions: [(カテゴリindex, 遷移先インデックス配列 or -1), ...]
+        """
+        if action is None:
+            return None
+
+        def mask_of(key, preds, all_):
+            if key not in self.category_index:
+                # 状態空間に無いカテゴリは常に None として評価
+                results = [p(None) for p in preds]
+                return None, (all(results) if all_ else any(results))
+            i = self.category_index[key]
+            m = np.array([all(p(v) for p in preds) if all_ else any(p(v) for p in preds)
+                          for v in self.values[i]], dtype=bool)
+            return i, m
+
+        all_of = []
+        for key, preds in action.required.all_of:
+            i, m = mask_of(key, preds, True)
+            if i is None:
+                if not m:
+                    return None
+                continue
+            all_of.append((i, m))
+
+        any_of = []
+        for key, preds in action.required.any_of:
+            i, m = mask_of(key, preds, False)
+            if i is None:
+                m = np.full(1, m, dtype=bool)
+                any_of.append((None, m))
+                continue
+            any_of.append((i, m))
+
+        transitions = []
+        for t in action.transitions:
+            if t.category not in self.category_index:
+                continue
+            i = self.category_index[t.category]
+            # all に無い値への遷移は状態空間外なので -1（実行不可扱い）
+            nmap = np.array([self.value_index[i].get(t.apply(v), -1) for v in self.values[i]],
+                            dtype=np.int64)
+            transitions.append((i, nmap))
+        return all_of, any_of, transitions
+
+    def transition(self, ids, action_id, digits=None):
+        """ids の各状態で action_id を実行した遷移先（実行不可なら -1）"""
+        ids = np.asarray(ids, dtype=np.int64)
+        rule = self._rules[action_id]
+        if rule is None:
+            return np.full(len(ids), -1, dtype=np.int64)
+        if digits is None:
+            digits = self.digits(ids)
+        all_of, any_of, transitions = rule
+
+        ok = np.ones(len(ids), dtype=bool)
+        for i, m in all_of:
+            ok &= m[digits[:, i]]
+        if any_of:
+            any_ok = np.zeros(len(ids), dtype=bool)
+            for i, m in any_of:
+                any_ok |= m[0] if i is None else m[digits[:, i]]
+            ok &= any_ok
+
+        nxt = ids.copy()
+        for i, nmap in transitions:
+            nd = nmap[digits[:, i]]
+            ok &= nd >= 0
+            nxt += (nd - digits[:, i]) * self.stride[i]
+        return np.where(ok, nxt, -1)
+
+    def after_wait(self, sid, duration, elapsed=None):
+        """sid で duration 秒待機した後の state_id と elapsed（自動遷移の結果が決まらなければ None）
+        @param elapsed: 自動遷移を持つカテゴリごとに、その値に入ってからの経過秒数の範囲
+                        （settle_auto_transition 参照）のリスト。None なら全て不明
+        @retval: (state_id, elapsed) または None
+        """
+        elapsed = list(elapsed) if elapsed is not None else [None] * len(self._auto)
+        for k, (i, rules) in enumerate(self._auto):
+            d = (sid // int(self.stride[i])) % int(self.radix[i])
+            settled = settle_auto_transition(rules, self.values[i][d], duration, elapsed[k])
+            if settled is None:
+                return None
+            value, elapsed[k] = settled
+            j = self.value_index[i].get(value)
+            if j is None:
+                return None
+            sid += (j - d) * int(self.stride[i])
+        return sid, elapsed
+
+    def reset_elapsed(self, before, after, elapsed=None):
+        """before -> after の遷移で値が変わったカテゴリの経過時間を 0 に戻した elapsed を返す"""
+        elapsed = list(elapsed) if elapsed is not None else [None] * len(self._auto)
+        for k, (i, _) in enumerate(self._auto):
+            stride, radix = int(self.stride[i]), int(self.radix[i])
+            if (before // stride) % radix != (after // stride) % radix:
+                elapsed[k] = (0.0, 0.0)
+        return elapsed
+
+    def transition_table(self, ids):
+        """next_state[len(ids), アクション数] の遷移表（実行不可なら -1）"""
+        ids = np.asarray(ids, dtype=np.int64)
+        digits = self.digits(ids)
+        table = np.empty((len(ids), len(self.actions)), dtype=np.int64)
+        for a in range(len(self.actions)):
+            table[:, a] = self.transition(ids, a, digits)
+        return table
+
+
+class TransitionTable:
+    """到達した状態だけを持つコンパクトな遷移表
+
+    状態は発見順のローカル index で管理し、state_ids[index] が StateSpace の state_id。
+    next_state[index, action_id] は遷移先のローカル index（実行不可なら -1）。
+    expanded[index] が False の行はまだ遷移を計算していない。
+    next_hop[src, dst] は src から dst への最短経路の最初のアクション（到達不可なら -1）。
+    全点対の表は build_next_hop で作り、無い始点は幅優先探索の結果を始点ごとにメモ化する。
+    save / load でキャッシュファイルに書き出し、memmap で読み戻せる。
+    """
+    def __init__(self, space, capacity=64):
+        self.space = space
+        self.n = 0
+        self.index = {}  # state_id -> ローカル index（キャッシュ読込後に追加した分のみ）
+        self.state_ids = np.empty(capacity, dtype=np.int64)
+        self.next_state = np.full((capacity, len(space.actions)), -1, dtype=np.int32)
+        self.expanded = np.zeros(capacity, dtype=bool)
+        self.next_hop = None
+        self._hops = {}  # 始点 -> (pred, pred_act)
+        # キャッシュから読み込んだ分の索引と状態名
+        self._sorted_ids = None
+        self._order = None
+        self._name_offsets = None
+        self._names = None
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self, size):
+        capacity = max(len(self.state_ids), 1)
+        if size <= capacity and self.next_state.flags.writeable:
+            return
+        while capacity < size:
+            capacity *= 2
+        state_ids = np.empty(capacity, dtype=np.int64)
+        state_ids[:self.n] = self.state_ids[:self.n]
+        next_state = np.full((capacity, len(self.space.actions)), -1, dtype=np.int32)
+        next_state[:self.n] = self.next_state[:self.n]
+        expanded = np.zeros(capacity, dtype=bool)
+        expanded[:self.n] = self.expanded[:self.n]
+        self.state_ids, self.next_state, self.expanded = state_ids, next_state, expanded
+
+    def lookup(self, sid):
+        """state_id のローカル index（未登録なら None）"""
+        idx = self.index.get(sid)
+        if idx is None and self._sorted_ids is not None:
+            pos = int(np.searchsorted(self._sorted_ids, sid))
+            if pos < len(self._sorted_ids) and self._sorted_ids[pos] == sid:
+                idx = int(self._order[pos])
+        return idx
+
+    def name(self, idx):
+        """ローカル index の状態名"""
+        if self._names is not None and idx < len(self._name_offsets) - 1:
+            return bytes(self._names[self._name_offsets[idx]:self._name_offsets[idx + 1]]).decode()
+        return self.space.name(int(self.state_ids[idx]))
+
+    def add(self, sid):
+        """state_id を登録してローカル index を返す"""
+        idx = self.lookup(sid)
+        if idx is None:
+            self._grow(self.n + 1)
+            idx = self.n
+            self.state_ids[idx] = sid
+            self.index[sid] = idx
+            self.n += 1
+        return idx
+
+    def expand(self, idxs):
+        """未展開の状態の遷移をまとめて計算する。新しく見つかった状態の index を返す"""
+        idxs = np.asarray(idxs, dtype=np.int64)
+        idxs = idxs[~self.expanded[idxs]]
+        if len(idxs) == 0:
+            return np.empty(0, dtype=np.int64)
+        self._grow(self.n)
+        table = self.space.transition_table(self.state_ids[idxs])
+        valid = table >= 0
+        uniq, inv = np.unique(table[valid], return_inverse=True)
+        before = self.n
+        local = np.array([self.add(int(sid)) for sid in uniq], dtype=np.int32)
+        rows = np.full(table.shape, -1, dtype=np.int32)
+        rows[valid] = local[inv]
+        self.next_state[idxs] = rows
+        self.expanded[idxs] = True
+        return np.arange(before, self.n, dtype=np.int64)
+
+    def after_wait(self, idx, duration, elapsed=None):
+        """状態 idx で duration 秒待機した後のローカル index と elapsed（決まらなければ (-1, None)）"""
+        settled = self.space.after_wait(int(self.state_ids[idx]), duration, elapsed)
+        if settled is None:
+            return -1, None
+        sid, elapsed = settled
+        return self.add(sid), elapsed
+
+    def build(self, roots, max_depth=None):
+        """roots（state_id）から到達可能な状態を幅優先で展開する。
+        max_depth を指定した場合はその深さで展開を止める（残りは必要時に展開）"""
+        frontier = np.unique(np.array([self.add(int(r)) for r in roots], dtype=np.int64))
+        depth = 0
+        while len(frontier) and (max_depth is None or depth < max_depth):
+            frontier = self.expand(frontier)
+            depth += 1
+
+    def row(self, idx):
+        """idx の遷移（必要なら展開してから）を返す"""
+        if not self.expanded[idx]:
+            self.expand([idx])
+        return self.next_state[idx]
+
+    def _bfs(self, src):
+        """src から到達できる状態を幅優先で展開し、最短経路木を返す
+        @retval: (pred: 直前の状態, pred_act: 直前のアクション, first_act: 最初のアクション)
+                 いずれもローカル index で引く配列（到達不可なら -1）
+        """
+        n_acts = len(self.space.actions)
+        pred = np.full(self.n, -1, dtype=np.int32)
+        pred_act = np.full(self.n, -1, dtype=np.int16)
+        first_act = np.full(self.n, -1, dtype=np.int16)
+        pred[src] = src
+        frontier = np.array([src], dtype=np.int64)
+        while len(frontier):
+            self.expand(frontier)
+            if len(pred) < self.n:
+                grow = self.n - len(pred)
+                pred = np.concatenate([pred, np.full(grow, -1, dtype=np.int32)])
+                pred_act = np.concatenate([pred_act, np.full(grow, -1, dtype=np.int16)])
+                first_act = np.concatenate([first_act, np.full(grow, -1, dtype=np.int16)])
+            dst = self.next_state[frontier].ravel().astype(np.int64)
+            frm = np.repeat(frontier, n_acts)
+            act = np.tile(np.arange(n_acts, dtype=np.int16), len(frontier))
+            new = dst >= 0
+            new[new] = pred[dst[new]] < 0
+            # 同じ状態に複数の経路で届く場合は最初に見つかったものを使う
+            dst, first = np.unique(dst[new], return_index=True)
+            frm, act = frm[new][first], act[new][first]
+            pred[dst] = frm
+            pred_act[dst] = act
+            first_act[dst] = np.where(frm == src, act, first_act[frm])
+            frontier = dst
+        return pred, pred_act, first_act
+
+    def build_next_hop(self, limit=NEXT_HOP_LIMIT):
+        """全点対の次ホップ表を作る。状態数が limit を超える、または未展開の状態が残っている場合は
+        作らずに False を返す（shortest_path は始点ごとの探索になる）"""
+        n = self.n
+        if n > limit or not self.expanded[:n].all():
+            return False
+        next_hop = np.full((n, n), -1, dtype=np.int16)
+        for src in range(n):
+            next_hop[src] = self._bfs(src)[2][:n]
+        self.next_hop = next_hop
+        return True
+
+    def shortest_path(self, src, dst):
+        """src から dst への最短経路のアクション index 列（到達できなければ None）"""
+        if src == dst:
+            return []
+        hop = self.next_hop
+        if hop is not None and src < len(hop) and dst < len(hop):
+            # 表の状態はすべて展開済みなので、後から追加された状態を経由する経路はない
+            if hop[src, dst] < 0:
+                return None
+            acts = []
+            cur = src
+            while cur != dst:
+                a = int(hop[cur, dst])
+                acts.append(a)
+                cur = int(self.next_state[cur, a])
+            return acts
+        tree = self._hops.get(src)
+        if tree is None:
+            pred, pred_act, _ = self._bfs(src)
+            # src から届く状態は全て展開済みなので、後で状態が増えてもこの木は変わらない
+            tree = self._hops[src] = (pred, pred_act)
+        pred, pred_act = tree
+        if dst >= len(pred) or pred[dst] < 0:
+            return None
+        acts = []
+        cur = dst
+        while cur != src:
+            acts.append(int(pred_act[cur]))
+            cur = int(pred[cur])
+        return acts[::-1]
+
+    def save(self, path, key):
+        """遷移表を1ファイルに書き出す（ヘッダJSON + 64byte境界に揃えた生配列）"""
+        n = self.n
+        names = [self.name(i).encode() for i in range(n)]
+        name_offsets = np.zeros(n + 1, dtype=np.int64)
+        name_offsets[1:] = np.cumsum([len(b) for b in names])
+        order = np.argsort(self.state_ids[:n], kind="stable")
+        arrays = {
+            "state_ids": np.ascontiguousarray(self.state_ids[:n]),
+            "next_state": np.ascontiguousarray(self.next_state[:n]),
+            "expanded": np.ascontiguousarray(self.expanded[:n]),
+            "sorted_ids": self.state_ids[:n][order],
+            "order": order.astype(np.int64),
+            "name_offsets": name_offsets,
+            "names": np.frombuffer(b"".join(names), dtype=np.uint8),
+        }
+        if self.next_hop is not None:
+            arrays["next_hop"] = np.ascontiguousarray(self.next_hop)
+        layout = {}
+        offset = 0
+        for k, arr in arrays.items():
+            layout[k] = [offset, arr.dtype.str, list(arr.shape)]
+            offset += -(-arr.nbytes // CACHE_ALIGN) * CACHE_ALIGN
+        header = json.dumps({"key": key, "actions": self.space.actions, "n": n,
+                             "arrays": layout}).encode()
+        data_start = -(-(len(CACHE_MAGIC) + 8 + len(header)) // CACHE_ALIGN) * CACHE_ALIGN
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(CACHE_MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            for k, arr in arrays.items():
+                f.seek(data_start + layout[k][0])
+                f.write(arr.tobytes())
+            f.truncate(data_start + offset)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, space, key):
+        """save したファイルを memmap で読み込む。キーが一致しなければ None"""
+        try:
+            with open(path, "rb") as f:
+                if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                    return None
+                size = int.from_bytes(f.read(8), "little")
+                header = json.loads(f.read(size))
+        except (OSError, ValueError):
+            return None
+        if header.get("key") != key or header.get("actions") != space.actions:
+            return None
+        data_start = -(-(len(CACHE_MAGIC) + 8 + size) // CACHE_ALIGN) * CACHE_ALIGN
+
+        arrays = {}
+        for k, (offset, dtype, shape) in header["arrays"].items():
+            if int(np.prod(shape)) == 0:
+                arrays[k] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[k] = np.memmap(path, dtype=dtype, mode="r",
+                                      offset=data_start + offset, shape=tuple(shape))
+
+        table = cls.__new__(cls)
+        table.space = space
+        table.n = header["n"]
+        table.index = {}
+        table.state_ids = arrays["state_ids"]
+        table.next_state = arrays["next_state"]
+        table.expanded = arrays["expanded"]
+        table._sorted_ids = arrays["sorted_ids"]
+        table._order = arrays["order"]
+        table._name_offsets = arrays["name_offsets"]
+        table._names = arrays["names"]
+        table.next_hop = arrays.get("next_hop")
+        table._hops = {}
+        return table
+
+    def check_paths(self, start, paths, waits=None):
+        """複数の経路をまとめて実行可能か検証する
+        @param start: 開始状態のローカル index
+        @param paths: (経路数, 長さ) のアクション index 配列。
+                      短い経路の残りは -1 で埋め、未知のアクションは -2 とする
+        @param waits: paths と同じ形の、各アクションの後の待機秒数（None なら待機なし）。
+                      待機後の状態が決まらない経路はそこから先を検証せず実行可能とみなす
+        @retval: (feasible: bool配列, first_fail: 最初に拒否される位置。実行可能なら -1)
+        """
+        paths = np.atleast_2d(np.asarray(paths, dtype=np.int64))
+        n, length = paths.shape
+        cur = np.full(n, start, dtype=np.int64)
+        first_fail = np.full(n, -1, dtype=np.int64)
+        alive = np.ones(n, dtype=bool)
+        elapsed = [None] * n
+        for j in range(length):
+            acts = paths[:, j]
+            rows = np.flatnonzero(alive & (acts != -1))
+            if len(rows) == 0:
+                break
+            self.expand(np.unique(cur[rows]))
+            a = acts[rows]
+            nxt = np.where(a >= 0, self.next_state[cur[rows], np.maximum(a, 0)], -1)
+            bad = nxt < 0
+            prev = cur[rows[~bad]]
+            first_fail[rows[bad]] = j
+            alive[rows[bad]] = False
+            cur[rows[~bad]] = nxt[~bad]
+            if waits is not None:
+                for r, src in zip(rows[~bad], prev):
+                    elapsed[r] = self.space.reset_elapsed(int(self.state_ids[src]),
+                                                          int(self.state_ids[cur[r]]), elapsed[r])
+                    if waits[r, j] > 0:
+                        cur[r], elapsed[r] = self.after_wait(cur[r], waits[r, j], elapsed[r])
+                        if cur[r] < 0:
+                            alive[r] = False
+        return first_fail < 0, first_fail
@@ -1,5 +1,5 @@
 from src.Model import TestModel
-from src.Explorer import ExplorerTree, ExplorerNode
+from src.ExplorerActbase import ExplorerTree, ExplorerNode
 from src.Engine import SearchEngine
 # from utils.dot_exporter import export_tree_to_dot, export_tree_to_networkx
 